@@ -1,3 +1,4 @@
+import struct
 from itertools import count
 from libs.huffman import *
 from libs.helpers import *
@@ -8,7 +9,10 @@ from libs.lzs import decompress, compress
 class Block:
     #TODO: Add data offset
     headerLen = 16
+    headerStruct = struct.Struct('<IIII')
     _ids = count(0)
+    __slots__ = ('id', 'valid', 'offset', 'numSubBlocks', 'subBlocks', 'sectors',
+                 'length', 'zeroBytes', 'header', 'data')
     def __init__(self, _id, sb=0, s=0, l=0, zb=0):
         self.id = _id
         self.valid = True
@@ -23,14 +27,17 @@ class Block:
     
     def parseHeader(self, header):
         self.header = header # save byte version
-        header = int.from_bytes(header,byteorder='little')
-        self.numSubBlocks = ( header & 0xFFFFFFFF )
-        header = header >> 32
-        self.sectors = ( header & 0xFFFFFFFF )
-        header = header >> 32
-        self.length = ( header & 0xFFFFFFFF )
-        header = header >> 32
-        self.zeroBytes = ( header & 0xFFFFFFFF )
+        # Short reads at the end of the file count as zeros
+        if len(header) < self.headerLen:
+            header = bytes(header).ljust( self.headerLen, b'\x00' )
+        self.numSubBlocks, self.sectors, self.length, self.zeroBytes = \
+            self.headerStruct.unpack_from( header, 0 )
+
+    def parseHeaderFrom(self, buf, pos):
+        # Same as parseHeader, reading straight from a buffer (bytes, mmap)
+        self.header = memoryview(buf)[pos:pos+16]
+        self.numSubBlocks, self.sectors, self.length, self.zeroBytes = \
+            self.headerStruct.unpack_from( buf, pos )
     
     def printBlockInfo(self):
         print( "BLOCK #%d: SB(%d) S(%d) L(%d) ZB(%d)" % \
@@ -40,6 +47,8 @@ class Block:
 # Data Class for SubBlocks within Blocks
 class SubBlock:
     headerLen = 16
+    headerStruct = struct.Struct('<IIIHH')
+    __slots__ = ('id', 'offset', 'length', 'compLength', 'unknown', 'flags', 'type', 'data')
     def __init__(self, _id=0):
         self.id = _id
         self.offset = 0
@@ -51,24 +60,18 @@ class SubBlock:
         self.data = 0
     
     def parseHeader(self, header):
-        header = int.from_bytes(header,byteorder='little')
-        self.compLength = ( header & 0xFFFFFFFF )
-        header = header >> 32
-        self.length = ( header & 0xFFFFFFFF )
-        header = header >> 32
-        self.unknown = ( header & 0xFFFFFFFF )
-        header = header >> 32
-        self.flags = ( header & 0xFFFF )
-        header = header >> 16
-        self.type = ( header & 0xFFFF )
+        if len(header) < self.headerLen:
+            header = bytes(header).ljust( self.headerLen, b'\x00' )
+        self.compLength, self.length, self.unknown, self.flags, self.type = \
+            self.headerStruct.unpack_from( header, 0 )
+
+    def parseHeaderFrom(self, buf, pos):
+        self.compLength, self.length, self.unknown, self.flags, self.type = \
+            self.headerStruct.unpack_from( buf, pos )
 
     def recalculateHeader(self):
-        header = self.compLength
-        header |= self.length << (32*1)
-        header |= self.unknown << (32*2)
-        header |= self.flags << (32*3)
-        header |= self.type << (32*3 + 16)
-        return header.to_bytes(16, byteorder='little')
+        return self.headerStruct.pack( self.compLength, self.length,
+            self.unknown, self.flags, self.type )
 
     
     def printBlockInfo(self):
@@ -81,6 +84,15 @@ class SubBlock:
 class TextBlock:
     #TODO: Add data offset
     headerLen = 24
+    headerStruct = struct.Struct('<IIIIII')
+    dHeaderStruct = struct.Struct('<IIIH5H')
+    __slots__ = ('id', 'parent', 'header', 'body',
+                 'a', 'a_off', 'uuid', 'huff_c', 'huff_d', 'huff_e', 'zero',
+                 'e1', 'e2', 'e3', 'encData',
+                 'one', 'd1_off', 'd2_off', 'd1len', 'd2len', 'd_var', 'd_entries',
+                 'd_a', 'dheader', 'd1', 'd2', 'd1_offs', '_d1_pages',
+                 'end_counter', 'end_block',
+                 '_hufftree', 'encHuffTree', '_decText')
     def __init__(self, subblock):
 
         self.id = subblock.id
@@ -105,43 +117,31 @@ class TextBlock:
         self.d1len = 0
         self.d2len = 0
         self.d_var = [0,0,0,0,0,0]
-        self.d1_pages = []
+        self._d1_pages = []
 
         # Decoded Outputs of the TextBlock
-        self.hufftree = []
+        # parse() only locates them, hufftree / decText / d1_pages are built
+        # on first access
+        self._hufftree = None
         self.encHuffTree = 0
-        self.decText = {}
+        self._decText = {}
 
         self.parseHeader()
     
     def parseHeader(self):
-        header = int.from_bytes(self.header,byteorder='little')
-        self.a_off = ( header & 0xFFFFFFFF )
-        header = header >> 32
-        self.uuid = ( header & 0xFFFFFFFF )
-        header = header >> 32
-        self.huff_c = ( header & 0xFFFFFFFF )
-        header = header >> 32
-        self.huff_d = ( header & 0xFFFFFFFF )
-        header = header >> 32
-        self.huff_e = ( header & 0xFFFFFFFF )
-        header = header >> 32
-        self.zero = ( header & 0xFFFFFFFF )
+        header = self.header
+        if len(header) < self.headerLen:
+            header = bytes(header).ljust( self.headerLen, b'\x00' )
+        self.a_off, self.uuid, self.huff_c, self.huff_d, self.huff_e, self.zero = \
+            self.headerStruct.unpack_from( header, 0 )
     
     def parseDHeader(self, dheader):
-        self.one = ( dheader & 0xFFFFFFFF )
-        dheader = dheader >> 32
-        self.d1_off = ( dheader & 0xFFFFFFFF )
-        dheader = dheader >> 32
-        self.d2_off = ( dheader & 0xFFFFFFFF )
-        dheader = dheader >> 32
-        self.d_entries = ( dheader & 0xFFFF )
-        dheader = dheader >> 16
-
+        if len(dheader) < self.dHeaderStruct.size:
+            dheader = bytes(dheader).ljust( self.dHeaderStruct.size, b'\x00' )
+        values = self.dHeaderStruct.unpack_from( dheader, 0 )
+        self.one, self.d1_off, self.d2_off, self.d_entries = values[:4]
         # 5 vars come after
-        for i in range(5):
-            self.d_var[i] = ( dheader & 0xFFFF )
-            dheader = dheader >> 16
+        self.d_var[:5] = values[4:]
     
     def printDHeader(self):
         print("-- -- -- D BLOCK O(%08X) D1(%08X) D2(%08X) DE[%04X] DV[%04X,%04X,%04X,%04X,%04X]" % ( \
@@ -166,7 +166,7 @@ class TextBlock:
         else:
             # If we do have d, we can extract this range, not sure what it is though
             self.d_a = byteSlice( self.body, self.huff_d, self.a_off, decode=False )
-            self.dheader = byteRead( self.body, self.huff_d, 28 )
+            self.dheader = byteRead( self.body, self.huff_d, 28, decode=False )
 
             self.d1len = self.d2_off - self.d1_off
             self.d2len = self.a_off - self.d2_off
@@ -182,72 +182,9 @@ class TextBlock:
                 print("D2 Block")
                 printHex( self.d2 )'''
 
+            # Pages are walked when d1_pages is first read
             if self.d_var[2] > 0:
-                idx = 0
-                self.d1_offs = []
-                for doff in range(self.d_entries):
-                    o = int.from_bytes( self.d1[idx:idx+2], byteorder='little' )
-                    self.d1_offs.append( o )
-                    idx+=2
-
-                idx = self.d1_offs[0]
-                if idx == 0:
-                    idx = 4
-                self.d1_pages = []
-                total_entries = 0
-                page = []
-                while True:
-                    ent = self.d1[idx:idx+8]
-                    if ent == bytearray(8):
-                        if total_entries == self.d_var[2]:
-                            self.d1_pages.append(page)
-                            break
-                        else:
-                            self.d1_pages.append(page)
-                            page = []
-                            idx+=8
-                            continue
-                    dent = {
-                        'offset': int.from_bytes(self.d1[idx:idx+4],byteorder='little'),
-                        'value': decodeShiftJIS(int.from_bytes(self.d1[idx+4:idx+6],byteorder='little')),
-                        'flag1': int.from_bytes(self.d1[idx+6:idx+7],byteorder='little'),
-                        'flag2': int.from_bytes(self.d1[idx+7:idx+8],byteorder='little')
-                    }
-                    page.append( dent )
-                    total_entries += 1
-                    idx+=8
-                for p in self.d1_pages:
-                    last_o = -1
-                    for e in p:
-                        # Make sure pages have offsets that are strictly decreasing
-                        if last_o != -1 and last_o < e['offset']:
-                            raise("ENTRY NOT DECREASING")
-                        
-                        # Make sure offsets are always less than d2len*4
-                        if e['offset'] > (self.d2len*4):
-                            raise("D1 OFFSET TOO BIG")
-                        
-                        # Make sure value is always valid shift-jis
-                        if e['value'] == '':
-                            raise("D1 VALUE NOT VALID SHIFTJIS")
-
-                        if e['flag1'] < 5 or e['flag2'] < 8:
-                            print(e['flag1'])
-                            print(e['flag2'])
-                            raise("FLAG LESS THAN THRESH")
-                        
-                        if e['flag1'] > 13 or e['flag2'] > 14:
-                            print(e['flag1'])
-                            print(e['flag2'])
-                            raise("FLAG GREATER THAN THRESH")
-
-                        # This one is not true
-                        # if e['flag1'] > e['flag2']:
-                        #     print(e['flag1'])
-                        #     print(e['flag2'])
-                        #     raise("FLAG1 GREATER THAN FLAG2")
-                        
-                        last_o = e['offset']
+                self._d1_pages = None
         
         # Read to the end of the block
         self.end_counter = byteRead( self.body, self.a_off+4, 4 )
@@ -256,12 +193,116 @@ class TextBlock:
         # This is the actual huffman tree
         self.encHuffTree = byteSlice( self.body, self.huff_e+10, self.huff_d, decode=False )
         
-        self.hufftree = makeHuffTree( self.encHuffTree )
-        self.decText = decodeHuffman( self.huff_c, self.encData, self.hufftree )
+        # Tree and text are decoded when first read
+        self._hufftree = None
+        self._decText = None
 
         #print( "a:%02X, e's: [%04X,%04X,%02X], htlen:%04X, edlen:%04X" %
         #    (self.a[0], self.e1, self.e2, self.e3, len(self.encHuffTree), len(self.encData)) )
     
+    def parseD1Pages(self):
+        pages = []
+        idx = 0
+        self.d1_offs = []
+        for doff in range(self.d_entries):
+            o = int.from_bytes( self.d1[idx:idx+2], byteorder='little' )
+            self.d1_offs.append( o )
+            idx+=2
+
+        idx = self.d1_offs[0]
+        if idx == 0:
+            idx = 4
+        total_entries = 0
+        page = []
+        while True:
+            ent = self.d1[idx:idx+8]
+            if ent == bytearray(8):
+                if total_entries == self.d_var[2]:
+                    pages.append(page)
+                    break
+                else:
+                    pages.append(page)
+                    page = []
+                    idx+=8
+                    continue
+            dent = {
+                'offset': int.from_bytes(self.d1[idx:idx+4],byteorder='little'),
+                'value': decodeShiftJIS(int.from_bytes(self.d1[idx+4:idx+6],byteorder='little')),
+                'flag1': int.from_bytes(self.d1[idx+6:idx+7],byteorder='little'),
+                'flag2': int.from_bytes(self.d1[idx+7:idx+8],byteorder='little')
+            }
+            page.append( dent )
+            total_entries += 1
+            idx+=8
+        for p in pages:
+            last_o = -1
+            for e in p:
+                # Make sure pages have offsets that are strictly decreasing
+                if last_o != -1 and last_o < e['offset']:
+                    raise("ENTRY NOT DECREASING")
+                
+                # Make sure offsets are always less than d2len*4
+                if e['offset'] > (self.d2len*4):
+                    raise("D1 OFFSET TOO BIG")
+                
+                # Make sure value is always valid shift-jis
+                if e['value'] == '':
+                    raise("D1 VALUE NOT VALID SHIFTJIS")
+
+                if e['flag1'] < 5 or e['flag2'] < 8:
+                    print(e['flag1'])
+                    print(e['flag2'])
+                    raise("FLAG LESS THAN THRESH")
+                
+                if e['flag1'] > 13 or e['flag2'] > 14:
+                    print(e['flag1'])
+                    print(e['flag2'])
+                    raise("FLAG GREATER THAN THRESH")
+
+                # This one is not true
+                # if e['flag1'] > e['flag2']:
+                #     print(e['flag1'])
+                #     print(e['flag2'])
+                #     raise("FLAG1 GREATER THAN FLAG2")
+                
+                last_o = e['offset']
+        return pages
+
+    @property
+    def hufftree(self):
+        # Identical trees across blocks share one parsed tree and decode table
+        if self._hufftree is None and self.encHuffTree:
+            self._hufftree = treePool.get( self.encHuffTree )
+        return self._hufftree
+
+    @hufftree.setter
+    def hufftree(self, value):
+        self._hufftree = value
+
+    @property
+    def decText(self):
+        if self._decText is None:
+            self._decText = decodeHuffman( self.huff_c, self.encData, self.hufftree )
+        return self._decText
+
+    @decText.setter
+    def decText(self, value):
+        self._decText = value
+
+    @property
+    def d1_pages(self):
+        if self._d1_pages is None:
+            self._d1_pages = self.parseD1Pages()
+        return self._d1_pages
+
+    @d1_pages.setter
+    def d1_pages(self, value):
+        self._d1_pages = value
+
+    def decodeAt(self, bitOffset):
+        # Single dialog at a bit offset from decText, reusing the tree's table
+        return self.hufftree.decodeTable().decodeAt( self.encData, bitOffset, self.huff_c )
+
     def printDBlockPages(self):
         for p in self.d1_pages:
             print("==========NEW PAGE============")
@@ -287,6 +328,16 @@ class TextBlock:
         #print("encTree")
         #printHex(encTree)
 
+        return self.buildBody( encText, encTree )
+
+    def encodeTranslations(self, dialogs, optimal=False):
+        # Encode every dialog of the block at once with a shared tree.
+        # Returns the new body and the bit offset of each dialog, in the
+        # same form as the 'offset' decodeHuffman reports.
+        [encText, encTree, offsets] = encodeHuffmanBlock( dialogs, self.huff_c, optimal )
+        return [self.buildBody( encText, encTree ), offsets]
+
+    def buildBody(self, encText, encTree):
         ## Structure: ##
         # 1. Header (24 Bytes)
         # 2. Huffman Code (codeLen Bytes)
@@ -372,6 +423,50 @@ class TextBlock:
 
         return buffer
 
+class KeywordTable:
+    """Precompiled matcher for ScriptBlock keyword / opcode names.
+
+    Gives the same answer as ScriptBlock.checkKeyword (first key, in dict
+    order, whose hex string equals the buffer, '*' matching any nibble) with
+    one dict lookup on the raw bytes. Keys with wildcards are tried in order
+    before an exact hit that comes after them.
+    """
+    _cache = {}
+
+    def __init__(self, kwds):
+        self.exact = {}
+        self.wild = {}
+        for pos, kwd in enumerate(kwds):
+            # The buffer's hex string is always lowercase and of even length
+            if len(kwd) % 2 or kwd.strip('0123456789abcdef*'):
+                continue
+            if '*' in kwd:
+                self.wild.setdefault( len(kwd) >> 1, [] ).append( (pos, kwd) )
+            else:
+                self.exact.setdefault( bytes.fromhex(kwd), (pos, kwd) )
+
+    @classmethod
+    def get(cls, kwds):
+        key = tuple(kwds)
+        table = cls._cache.get( key )
+        if table is None:
+            table = cls._cache[key] = cls( key )
+        return table
+
+    def find(self, buff):
+        # Matching key or None
+        buff = bytes(buff)
+        hit = self.exact.get( buff )
+        wild = self.wild.get( len(buff) )
+        if wild:
+            strbuff = buff.hex()
+            for pos, kwd in wild:
+                if hit is not None and hit[0] < pos:
+                    break
+                if all( k == '*' or k == c for k, c in zip(kwd, strbuff) ):
+                    return kwd
+        return hit[1] if hit is not None else None
+
 # Data Class for SubBlocks within Blocks
 class ScriptBlock:
     def __init__(self, subblock):
@@ -392,6 +487,9 @@ class ScriptBlock:
             self.raw = decompress( self.parent.data, self.parent.length )
         else:
             self.raw = self.parent.data
+        # Zero-copy parsing hands out views of the file, we need real bytes
+        if isinstance(self.raw, memoryview):
+            self.raw = self.raw.tobytes()
 
         self.opCodes = {
             'b401a0': {'name': '', 'raw': None, 'data': [], 'dataLen': [0]  },
@@ -539,6 +637,33 @@ class ScriptBlock:
             return False
         self.raw = self.raw.replace(needle,new)
         return True
+
+    def replaceOffsets(self, offsets):
+        # Bulk replaceOffset: offsets maps (dialog, oldOff) -> newOff, or
+        # oldOff -> newOff for a reference to any dialog. All c021a0
+        # references are found in one scan and patched in place (raw becomes
+        # a bytearray). All keys are applied at once, so a new offset is never
+        # rewritten again by another key. Returns the keys that matched nothing.
+        if not isinstance(self.raw, bytearray):
+            self.raw = bytearray(self.raw)
+        raw = self.raw
+        found = set()
+        pos = raw.find(b'\xc0\x21\xa0')
+        while pos != -1 and pos + 7 <= len(raw):
+            oldOff = raw[pos+3] | (raw[pos+4] << 8)
+            arg = raw[pos+5] | (raw[pos+6] << 8)
+            key = (arg >> 4, oldOff)
+            if arg & 0xF or key not in offsets:
+                key = oldOff
+            if key in offsets:
+                newOff = offsets[key]
+                raw[pos+3] = newOff & 0xFF
+                raw[pos+4] = (newOff >> 8) & 0xFF
+                found.add( key )
+                pos = raw.find(b'\xc0\x21\xa0', pos+7)
+            else:
+                pos = raw.find(b'\xc0\x21\xa0', pos+1)
+        return [key for key in offsets if key not in found]
             
     def checkKeyword(self, buff, kwds):
         strbuff = ''
@@ -557,6 +682,10 @@ class ScriptBlock:
     def parseBody(self, body):
         self.body = body
 
+        # Same matching as checkKeyword, but straight on the bytes
+        keywords = KeywordTable.get( self.keywords )
+        opCodes = KeywordTable.get( self.opCodes )
+
         buff = []
 
         # First two characters always 0x00
@@ -564,6 +693,7 @@ class ScriptBlock:
 
         fill = False
         filledBytes = 0
+        fillLen = 0
         entry = None
 
         offset = 0
@@ -575,8 +705,8 @@ class ScriptBlock:
                 buff.append(x)
 
                 if len(buff) == 1 or len(buff) == 2:
-                    found, kwd = self.checkKeyword(buff, self.keywords.keys())
-                    if found:
+                    kwd = keywords.find( buff )
+                    if kwd is not None:
                         #print( f"Found Keyword: {kwd}")
                         entry = self.keywords[kwd].copy()
                         entry['name'] = kwd
@@ -589,12 +719,11 @@ class ScriptBlock:
                             fill = False
                         else:      
                             fill = True
-                        buff = []
-                    if len(buff) == 4 and not found:
+                            fillLen = sum(entry['dataLen'])
                         buff = []
                 if len(buff) == 3:
-                    found, opc = self.checkKeyword(buff, self.opCodes.keys())
-                    if found:
+                    opc = opCodes.find( buff )
+                    if opc is not None:
                         #print( f"Found OpCode: {opc}")
                         entry = self.opCodes[opc].copy()
 
@@ -613,8 +742,10 @@ class ScriptBlock:
                             fill = False
                         else:      
                             fill = True
+                            fillLen = sum(entry['dataLen'])
                         buff = []
                     else:
+                        opc = bytes(buff).hex()
                         if '0000' not in opc and '0100' not in opc and '0200' not in opc:
                             print( f"Invalid OpCode: {opc}", end='')
                             print( f" Following Bytes {body[offset-8:offset-2].hex()}",end=' ')
@@ -622,18 +753,13 @@ class ScriptBlock:
                             print( f"{body[offset+1:offset+24].hex()}")
                             return opc
                         return ''
-                        buff = []
-                if len(buff) > 3:
-                    buff = []
-                    print( f"Something went wrong: {buff}", end='')
-                    return ''
             # Here we'll fill the data
             else:
                 entry['raw'].append( x )
                 filledBytes += 1
 
                 # check to see if we've filled the raw data
-                if filledBytes >= sum(entry['dataLen']):
+                if filledBytes >= fillLen:
                     idx = len(entry['name'])>>1
                     for i in entry['dataLen']:
                         entry['data'].append( entry['raw'][idx:idx+i] )
@@ -0,0 +1,71 @@
+import struct
+from collections import namedtuple
+from libs.recordfile import saveRecords, loadRecords
+
+# Dialog lookup index
+#
+# One record per dialog the extractor numbered, keyed three ways: sequential
+# dialog id, TextBlock uuid and absolute text offset (as written to
+# dq4_address_mapping.csv). bitOffset is the offset decodeHuffman reports,
+# counted from the start of the TextBlock body. The file holds the content
+# hash of the ROM it was built from (see libs.hbd1index.romHash).
+
+MAGIC = b'DQDX'
+VERSION = 1
+
+RECORD = struct.Struct('<IIIIIHII')
+
+DialogRecord = namedtuple('DialogRecord',
+    'dialogId uuid blockOffset subBlockHeader subBlockBody subBlockIdx bitOffset absoluteOffset')
+
+class DialogIndex:
+    def __init__(self, romHash=b''):
+        self.romHash = romHash
+        self.records = []
+        self.byId = {}
+        self.byUuid = {}
+        self.byOffset = {}
+
+    def __len__(self):
+        return len(self.records)
+
+    def add(self, dialogId, uuid, blockOffset, subBlockHeader, subBlockBody,
+            subBlockIdx, bitOffset, absoluteOffset):
+        rec = DialogRecord( dialogId, uuid, blockOffset, subBlockHeader, subBlockBody,
+                            subBlockIdx, bitOffset, absoluteOffset )
+        self.records.append( rec )
+        self.byId[dialogId] = rec
+        self.byUuid.setdefault( uuid, [] ).append( rec )
+        self.byOffset.setdefault( absoluteOffset, rec )
+        return rec
+
+    # Lookups
+    def dialog(self, dialogId):
+        # dialogId can be an int or a hex string ('0x0001' / '0001')
+        if isinstance(dialogId, str):
+            dialogId = int( dialogId, 16 )
+        return self.byId.get( dialogId )
+
+    def textBlock(self, uuid):
+        # Every dialog of the TextBlock with this uuid, in order
+        return self.byUuid.get( uuid, [] )
+
+    def atOffset(self, absoluteOffset):
+        # First dialog recorded at that offset
+        return self.byOffset.get( absoluteOffset )
+
+    def save(self, path):
+        saveRecords( path, MAGIC, VERSION, self.romHash, RECORD, self.records )
+
+    @classmethod
+    def load(cls, path, romHash=None):
+        # Returns None if the file is missing, damaged or (when romHash is
+        # given) was built from another ROM
+        loaded = loadRecords( path, MAGIC, VERSION, RECORD, romHash )
+        if loaded is None:
+            return None
+        _hash, records = loaded
+        index = cls( _hash )
+        for rec in records:
+            index.add( *rec )
+        return index
@@ -0,0 +1,248 @@
+import os
+import mmap
+import struct
+import bisect
+import hashlib
+from collections import namedtuple
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Block / sub-block index of HBD1PS1D.Q41
+#
+# The archive is scanned once, the same way the extractor walks it: a block
+# starts on a sector holding MAGIC, followed by a 16 byte block header and
+# one 16 byte header per sub-block, then the sub-block bodies back to back.
+# The result is saved as a small binary file next to the ROM (<rom>.idx) and
+# reused as long as the ROM is the same file (size and mtime) or, failing
+# that, has the same content hash.
+
+MAGIC = b'\x00\x00\x08\x00\x00\x00\x08\x00'
+SECTOR = 2048
+VERSION = 1
+
+FILE_HEADER = struct.Struct('<4sIQQ16sII')
+BLOCK = struct.Struct('<IIII')
+SUBBLOCK = struct.Struct('<IIIIIHHI')
+
+# offset is where MAGIC is, firstSub the index of its first sub-block
+IndexBlock = namedtuple('IndexBlock', 'id offset sectors numSubBlocks firstSub')
+# headerOffset/bodyOffset are absolute; uuid is only set for TextBlocks
+IndexSubBlock = namedtuple('IndexSubBlock',
+    'id block idx headerOffset bodyOffset compLength length unknown flags type uuid')
+
+TEXT_TYPES = (40, 42)
+
+# One row per sub-block for subBlockTable
+SUBBLOCK_DTYPE = [('block', '<u4'), ('idx', '<u2'), ('headerOffset', '<u4'),
+                  ('bodyOffset', '<u4'), ('compLength', '<u4'), ('length', '<u4'),
+                  ('unknown', '<u4'), ('flags', '<u2'), ('type', '<u2'), ('uuid', '<u4')]
+
+def romHash(buf):
+    h = hashlib.blake2b( digest_size=16 )
+    view = memoryview(buf)
+    for pos in range(0, len(view), 1 << 24):
+        h.update( view[pos:pos + (1 << 24)] )
+    return h.digest()
+
+def scanArchive(buf):
+    # Yields (offset, sectors, [(headerOffset, bodyOffset, compLength, length,
+    # unknown, flags, type, uuid), ...]) for every valid block
+    size = len(buf)
+    pos = 0
+    while pos < size:
+        # Next sector holding the magic
+        found = buf.find( MAGIC, pos )
+        if found == -1:
+            return
+        if (found - pos) % SECTOR:
+            pos += ((found - pos) // SECTOR + 1) * SECTOR
+            continue
+        pos = found
+        if pos + 24 > size:
+            return
+
+        numSub, numSect, totalLen, zero = struct.unpack_from( '<IIII', buf, pos+8 )
+        if not (1 <= numSub <= 20 and 1 <= numSect <= 200 and totalLen > 0):
+            pos += SECTOR
+            continue
+
+        headers = []
+        hdr = pos + 24
+        body = hdr + numSub*16
+        for i in range(numSub):
+            if hdr + 16 > size:
+                body = size
+                break
+            headers.append( (hdr,) + struct.unpack_from( '<IIIHH', buf, hdr ) )
+            hdr += 16
+
+        subs = []
+        for headerOffset, compLength, length, unknown, flags, _type in headers:
+            # Bodies the extractor skips don't take up space either
+            bodyOffset = body
+            if 0 < compLength < 10 * 1024 * 1024:
+                body += compLength
+            uuid = 0
+            if _type in TEXT_TYPES and compLength >= 8 and bodyOffset + 8 <= size:
+                uuid = struct.unpack_from( '<I', buf, bodyOffset+4 )[0]
+            subs.append( (headerOffset, bodyOffset, compLength, length, unknown, flags, _type, uuid) )
+
+        yield (pos, numSect, subs)
+        pos += numSect * SECTOR
+
+class HBD1Index:
+    def __init__(self):
+        self.romPath = None
+        self.size = 0
+        self.mtime = 0
+        self.hash = b''
+        self.blocks = []
+        self.subBlocks = []
+        self.byType = {}
+        self.byUuid = {}
+        self.blockOffsets = []
+
+    @classmethod
+    def open(cls, romPath, indexPath=None, rebuild=False):
+        # Load the index next to the ROM, building (and saving) it if it is
+        # missing or stale
+        indexPath = indexPath or romPath + '.idx'
+        st = os.stat( romPath )
+        index = None
+        if not rebuild:
+            index = cls.load( indexPath )
+        if index is not None and (index.size != st.st_size or index.mtime != st.st_mtime_ns):
+            # Touched or copied, but maybe not changed
+            with open(romPath, 'rb') as fh, mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                same = index.size == st.st_size and romHash( mm ) == index.hash
+            if same:
+                index.mtime = st.st_mtime_ns
+                index.save( indexPath )
+            else:
+                index = None
+        if index is None:
+            index = cls.build( romPath )
+            index.save( indexPath )
+        index.romPath = romPath
+        return index
+
+    @classmethod
+    def build(cls, romPath):
+        index = cls()
+        st = os.stat( romPath )
+        index.romPath = romPath
+        index.size = st.st_size
+        index.mtime = st.st_mtime_ns
+        if st.st_size == 0:
+            return index
+        with open(romPath, 'rb') as fh, mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            index.hash = romHash( mm )
+            for offset, sectors, subs in scanArchive( mm ):
+                index.addBlock( offset, sectors, subs )
+        return index
+
+    def addBlock(self, offset, sectors, subs):
+        block = len(self.blocks)
+        self.blocks.append( IndexBlock( block, offset, sectors, len(subs), len(self.subBlocks) ) )
+        self.blockOffsets.append( offset )
+        for idx, sub in enumerate(subs):
+            sb = IndexSubBlock( len(self.subBlocks), block, idx, *sub )
+            self.subBlocks.append( sb )
+            self.byType.setdefault( sb.type, [] ).append( sb )
+            if sb.type in TEXT_TYPES:
+                self.byUuid.setdefault( sb.uuid, sb )
+
+    def save(self, indexPath):
+        buffer = bytearray()
+        buffer.extend( FILE_HEADER.pack( b'HBDX', VERSION, self.size, self.mtime,
+            self.hash, len(self.blocks), len(self.subBlocks) ) )
+        for b in self.blocks:
+            buffer.extend( BLOCK.pack( b.offset, b.sectors, b.numSubBlocks, b.firstSub ) )
+        for sb in self.subBlocks:
+            buffer.extend( SUBBLOCK.pack( *sb[3:] ) )
+        tmp = indexPath + '.tmp'
+        with open(tmp, 'wb') as fh:
+            fh.write( buffer )
+        os.replace( tmp, indexPath )
+
+    @classmethod
+    def load(cls, indexPath):
+        try:
+            with open(indexPath, 'rb') as fh:
+                data = fh.read()
+            magic, version, size, mtime, _hash, numBlocks, numSubs = \
+                FILE_HEADER.unpack_from( data, 0 )
+        except (OSError, struct.error):
+            return None
+        end = FILE_HEADER.size + numBlocks*BLOCK.size + numSubs*SUBBLOCK.size
+        if magic != b'HBDX' or version != VERSION or len(data) != end:
+            return None
+
+        index = cls()
+        index.size = size
+        index.mtime = mtime
+        index.hash = _hash
+        pos = FILE_HEADER.size
+        subs = struct.iter_unpack( SUBBLOCK.format, data[pos + numBlocks*BLOCK.size:] )
+        for offset, sectors, numSub, firstSub in struct.iter_unpack( BLOCK.format, data[pos:pos + numBlocks*BLOCK.size] ):
+            index.addBlock( offset, sectors, [next(subs) for i in range(numSub)] )
+        return index
+
+    # Lookups
+    def subBlocksOfType(self, *types):
+        # In file order, like a scan would find them
+        if len(types) == 1:
+            return list(self.byType.get( types[0], [] ))
+        return [sb for sb in self.subBlocks if sb.type in types]
+
+    def textBlocks(self):
+        return self.subBlocksOfType( *TEXT_TYPES )
+
+    def textBlock(self, uuid):
+        return self.byUuid.get( uuid )
+
+    def blockAt(self, offset):
+        # Block whose sectors contain offset, or None
+        i = bisect.bisect_right( self.blockOffsets, offset ) - 1
+        if i < 0:
+            return None
+        b = self.blocks[i]
+        return b if offset < b.offset + b.sectors*SECTOR else None
+
+    def subBlockAt(self, offset):
+        # Sub-block whose header or body contains offset, or None
+        b = self.blockAt( offset )
+        if b is None:
+            return None
+        for sb in self.subBlocks[b.firstSub:b.firstSub + b.numSubBlocks]:
+            if sb.headerOffset <= offset < sb.headerOffset + 16 or \
+               sb.bodyOffset <= offset < sb.bodyOffset + sb.compLength:
+                return sb
+        return None
+
+    def subBlocksOf(self, block):
+        return self.subBlocks[block.firstSub:block.firstSub + block.numSubBlocks]
+
+def subBlockTable(source):
+    # NumPy structured array with every sub-block header of the archive, e.g.
+    #   t = subBlockTable('input/HBD1PS1D.Q41')
+    #   t['compLength'][(t['type'] == 39) & (t['flags'] == 1280)].sum()
+    # source is an HBD1Index (no ROM access) or the ROM path (one pass over
+    # an mmap, nothing saved)
+    if numpy is None:
+        raise ImportError( "subBlockTable needs numpy" )
+    dtype = numpy.dtype( SUBBLOCK_DTYPE )
+    if isinstance(source, HBD1Index):
+        rows = ( (sb.block, sb.idx) + tuple(sb[3:]) for sb in source.subBlocks )
+        return numpy.fromiter( rows, dtype=dtype, count=len(source.subBlocks) )
+
+    if os.path.getsize( source ) == 0:
+        return numpy.zeros( 0, dtype=dtype )
+    with open(source, 'rb') as fh, mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        rows = ( (block, idx) + sub
+                 for block, (offset, sectors, subs) in enumerate(scanArchive( mm ))
+                 for idx, sub in enumerate(subs) )
+        return numpy.fromiter( rows, dtype=dtype )
@@ -1,3 +1,10 @@
+import re
+import sys
+import time
+import heapq
+import hashlib
+from array import array
+from collections import OrderedDict, Counter
 from libs.shiftjis import decodeShiftJIS, encodeShiftJIS
 from libs.helpers import printHex, compHex
 
@@ -25,74 +32,482 @@ def parseTree( switch, offset, curNode, bytes):
 
 
 def makeHuffTree( rawHuff ):
-    root = [None,None]
-    # Last two bytes are just zeros
-    rawHuff = list(rawHuff)[:-2]
-    raw_length = len(rawHuff)
-    half = int(raw_length / 2)
+    # Nested list version of the tree, kept for code that indexes it directly
+    return HuffTree( rawHuff ).toList()
+
+def parseHuffTree( rawHuff, strict=True ):
+    return HuffTree( rawHuff, strict=strict )
+
+# Leaf strings are shared by every tree in the process
+leafTextCache = {}
+
+def leafText( code ):
+    text = leafTextCache.get( code )
+    if text is None:
+        hByte = code >> 8
+        lByte = code & 0xFF
+        if( hByte == 0x7F or hByte == 0x7E ):
+            text = "{%02x%02x}" % (hByte, lByte)
+        elif( code == 0 ):
+            text = "{0000}"
+        else:
+            text = decodeShiftJIS( ((hByte + 0x80) << 8) + lByte )
+        leafTextCache[code] = text
+    return text
+
+class HuffTree:
+    """Huffman tree kept in flat arrays instead of nested lists.
+
+    children holds two slots per internal node (left, right), node 0 being
+    the root. A slot below LEAF is the index of another node; a slot with the
+    LEAF bit set indexes the leaf table, where leafCodes has the raw 16-bit
+    value from the tree bytes and leafText its decoded string. Leaves are
+    interned, so a symbol shows up once in the table however many times the
+    tree points at it.
+
+    With strict=False, pointers past the end of the tree bytes become a None
+    leaf instead of raising, which is what the extractor always did.
+    """
+    LEAF = 0x8000
+
+    def __init__(self, rawHuff=None, strict=True):
+        self.children = array('H')
+        self.leafCodes = array('H')
+        self.leafText = []
+        self.leafIds = {}
+        self.raw = None
+        self.key = None
+        self.table = None
+        self.cachedEntries = None
+        if rawHuff is not None:
+            self.parse( rawHuff, strict )
+
+    def addLeaf(self, key, text, code):
+        idx = self.leafIds.get( key )
+        if idx is None:
+            idx = len(self.leafText)
+            self.leafIds[key] = idx
+            self.leafText.append( text )
+            self.leafCodes.append( code )
+        return self.LEAF | idx
+
+    def parse(self, rawHuff, strict=True):
+        self.raw = bytes(rawHuff)
+        # Last two bytes are just zeros
+        raw = self.raw[:-2]
+        raw_length = len(raw)
+        half = int(raw_length / 2)
+
+        # Calculate the root node
+        lByte = raw[ raw_length - 2 ] + ( raw[ raw_length - 1 ] << 8 )
+        rootNode = 1 + lByte - 0x8000
+
+        # Walk the nodes breadth first, numbering them as we find them. A node
+        # pointed at from two places gets a copy of its subtree each time,
+        # like the recursive walker did; only a node inside its own subtree
+        # (which would never end) is rejected.
+        nodes = [rootNode]
+        parents = [-1]
+        seen = {rootNode}
+        idx = 0
+        while idx < len(nodes):
+            curNode = nodes[idx]
+            for switch in (0, 1):
+                index = curNode * 2 + ( half if switch else 0 )
+                if not strict and index + 1 >= raw_length:
+                    self.children.append( self.addLeaf( None, None, 0xFFFF ) )
+                    continue
+                hByte = raw[ index + 1 ]
+                lByte = raw[ index ]
+                if( (hByte&0xF0) == 0x80 ):
+                    node = (hByte << 8) + lByte - 0x8000
+                    if node in seen:
+                        parent = idx
+                        while parent != -1:
+                            if nodes[parent] == node:
+                                raise ValueError( "Huffman tree node %d is its own descendant" % node )
+                            parent = parents[parent]
+                    seen.add( node )
+                    self.children.append( len(nodes) )
+                    nodes.append( node )
+                    parents.append( idx )
+                else:
+                    code = (hByte << 8) + lByte
+                    self.children.append( self.addLeaf( code, leafText( code ), code ) )
+            idx += 1
+        return self
+
+    @classmethod
+    def fromList(cls, huff):
+        # Build from a makeHuffTree style nested list (leaf codes are unknown)
+        tree = cls()
+        nodes = [huff]
+        idx = 0
+        while idx < len(nodes):
+            for child in nodes[idx]:
+                if type(child) == list:
+                    tree.children.append( len(nodes) )
+                    nodes.append( child )
+                else:
+                    tree.children.append( tree.addLeaf( child, child, 0xFFFF ) )
+            idx += 1
+        return tree
+
+    def digest(self):
+        # Identity of the tree: hash of the raw bytes it was parsed from
+        if self.key is None and self.raw is not None:
+            self.key = hashlib.blake2b( self.raw, digest_size=16 ).digest()
+        return self.key
+
+    def dump(self):
+        # Plain tuple (marshal friendly) with the tree and its lookup table,
+        # if one was built
+        lookup = self.table.lookup if self.table is not None else []
+        return (self.raw, self.children.tobytes(), self.leafCodes.tobytes(),
+                self.leafText, self.leafIds, lookup)
+
+    @classmethod
+    def load(cls, state):
+        raw, children, leafCodes, leafText, leafIds, lookup = state
+        tree = cls()
+        tree.raw = raw
+        tree.children.frombytes( children )
+        tree.leafCodes.frombytes( leafCodes )
+        tree.leafText = list(leafText)
+        tree.leafIds = leafIds
+        if lookup:
+            tree.table = DecodeTable( tree, lookup )
+        return tree
+
+    def memorySize(self):
+        # Rough footprint of the parsed tree (leaf strings are shared)
+        return sys.getsizeof(self.children) + sys.getsizeof(self.leafCodes) + \
+            sys.getsizeof(self.leafText) + sys.getsizeof(self.leafIds)
+
+    def numNodes(self):
+        return len(self.children) >> 1
+
+    def isEmpty(self):
+        # Both root children are empty leaves
+        for child in self.children[:2]:
+            if child < self.LEAF or self.leafText[child & 0x7FFF]:
+                return False
+        return True
+
+    def toList(self):
+        # Children always have a larger index than their parent
+        built = [None] * self.numNodes()
+        for node in range(self.numNodes() - 1, -1, -1):
+            pair = [None, None]
+            for bit in (0, 1):
+                child = self.children[(node << 1) | bit]
+                if child & self.LEAF:
+                    pair[bit] = self.leafText[child & 0x7FFF]
+                else:
+                    pair[bit] = built[child]
+            built[node] = pair
+        return built[0] if built else [None, None]
+
+    def decodeTable(self):
+        if self.table is None:
+            self.table = DecodeTable( self )
+        return self.table
+
+class TreePool:
+    """Process-wide pool of parsed trees, keyed by the hash of their bytes.
+
+    TextBlocks that carry byte-identical trees get the same HuffTree back, and
+    with it the same decode table and code map. The counters say how many
+    distinct trees were seen and what the sharing saved.
+
+    If cache is set (a libs.treecache.TreeCache), trees missing from the pool
+    are loaded from disk before parsing, and flush() writes new or grown ones
+    back.
+    """
+    def __init__(self, cache=None):
+        self.cache = cache
+        self.trees = {}
+        self.parseTimes = {}
+        self.lookups = 0
+        self.hits = 0
+        self.diskHits = 0
+        self.savedBytes = 0
+        self.savedMemory = 0
+        self.savedTime = 0.0
+
+    def get(self, rawHuff, strict=True):
+        raw = bytes(rawHuff)
+        digest = hashlib.blake2b( raw, digest_size=16 ).digest()
+        key = (digest, strict)
+        self.lookups += 1
+        tree = self.trees.get( key )
+        if tree is not None:
+            self.hits += 1
+            self.savedBytes += len(raw)
+            self.savedMemory += tree.memorySize()
+            self.savedTime += self.parseTimes[key]
+            return tree
+
+        start = time.perf_counter()
+        tree = self.cache.load( digest, strict ) if self.cache is not None else None
+        if tree is not None:
+            self.diskHits += 1
+        else:
+            tree = HuffTree( raw, strict=strict )
+        self.parseTimes[key] = time.perf_counter() - start
+        tree.key = digest
+        self.trees[key] = tree
+        return tree
+
+    def flush(self):
+        if self.cache is None:
+            return 0
+        written = 0
+        for (digest, strict), tree in self.trees.items():
+            if self.cache.save( tree, strict ):
+                written += 1
+        self.cache.evict()
+        return written
+
+    def clear(self):
+        self.__init__( self.cache )
+
+    def stats(self):
+        return {'distinct': len(self.trees), 'lookups': self.lookups,
+                'hits': self.hits, 'diskHits': self.diskHits,
+                'savedBytes': self.savedBytes, 'savedMemory': self.savedMemory,
+                'savedTime': self.savedTime}
+
+treePool = TreePool()
+
+class DecodeTable:
+    """Multi-bit lookup decoder for a HuffTree.
+
+    The table is built in one pass over the tree when the DecodeTable is made.
+    It is indexed by the next `bits` bits of the code, LSB first (at most
+    LOOKUP_BITS, fewer for shallow trees). Each entry is (length, leaf) for a
+    symbol whose code fits in those bits, so one lookup emits a symbol and
+    says how many bits it used. Longer codes get (0, node): all `bits` bits
+    are used up, and the rest of the symbol is walked bit by bit from that
+    internal node. Those are the rarest symbols of the tree.
+    """
+    LOOKUP_BITS = 10
+
+    def __init__(self, huff, lookup=None):
+        if not isinstance(huff, HuffTree):
+            huff = HuffTree.fromList( huff )
+        self.tree = huff
+        self.bits = 0
+        self.lookup = []
+        if lookup:
+            # Built before (see HuffTree.load)
+            self.bits = len(lookup).bit_length() - 1
+            self.lookup = list(lookup)
+        elif len(huff.children):
+            self.build()
+
+    def build(self):
+        children = self.tree.children
+        LEAF = HuffTree.LEAF
+
+        # Children always have a larger index than their parent
+        depth = [0] * self.tree.numNodes()
+        maxDepth = 1
+        for node in range(len(depth)):
+            for bit in (0, 1):
+                child = children[(node << 1) | bit]
+                if child < LEAF:
+                    depth[child] = depth[node] + 1
+                    maxDepth = max( maxDepth, depth[child] + 1 )
+        bits = min( maxDepth, self.LOOKUP_BITS )
+
+        size = 1 << bits
+        lookup = [None] * size
+        stack = [(0, 0, 0)]
+        while stack:
+            node, code, length = stack.pop()
+            length += 1
+            for bit in (0, 1):
+                child = children[(node << 1) | bit]
+                childCode = code | (bit << (length - 1))
+                if child >= LEAF:
+                    # Every index whose low bits are this code
+                    lookup[childCode::1 << length] = [(length, child & 0x7FFF)] * (size >> length)
+                elif length == bits:
+                    lookup[childCode] = (0, child)
+                else:
+                    stack.append( (child, childCode, length) )
+        self.bits = bits
+        self.lookup = lookup
+        return self
+
+    def iterLeaves(self, code, bit=0):
+        # Yields (bit after the symbol, leaf index) for every symbol from bit
+        # on. A symbol cut off by the end of the code is not yielded.
+        children = self.tree.children
+        lookup = self.lookup
+        bits = self.bits
+        mask = (1 << bits) - 1
+        end = len(code) * 8
+        data = bytes(code) + b'\x00\x00\x00'
+        fromBytes = int.from_bytes
+        pos = bit
+        while pos < end:
+            i = pos >> 3
+            length, leaf = lookup[(fromBytes( data[i:i+3], 'little' ) >> (pos & 7)) & mask]
+            if length:
+                pos += length
+                if pos > end:
+                    return
+            else:
+                # Code longer than the table, walk the rest
+                pos += bits
+                while True:
+                    if pos >= end:
+                        return
+                    child = children[(leaf << 1) | ((data[pos >> 3] >> (pos & 7)) & 1)]
+                    pos += 1
+                    if child >= HuffTree.LEAF:
+                        leaf = child & 0x7FFF
+                        break
+                    leaf = child
+            yield pos, leaf
+
+    def iterDecode(self, offset, code):
+        # Yields (bitOffset, text) as soon as each {0000} is reached
+        leafText = self.tree.leafText
+        parts = []
+        base = offset * 8
+        start = base
+        for pos, leaf in self.iterLeaves(code):
+            text = leafText[leaf]
+            parts.append(text)
+            if text == '{0000}':
+                yield (start, ''.join(parts))
+                parts = []
+                start = base + pos
+
+    def decode(self, offset, code):
+        return [ {'text':text,'offset':'0x%04X' % bitOffset}
+                 for bitOffset, text in self.iterDecode(offset, code) ]
+
+    def decodeAt(self, code, bitOffset, offset=0):
+        # Decode only the dialog starting at bitOffset (the value decodeHuffman
+        # reports, so offset is the byte position of code in the block).
+        # Returns its text up to and including {0000}, or None if the code
+        # runs out first.
+        bit = bitOffset - offset*8
+        if bit < 0 or (bit >> 3) >= len(code):
+            raise ValueError( "Bit offset 0x%04X is outside the code" % bitOffset )
+        leafText = self.tree.leafText
+        parts = []
+        for pos, leaf in self.iterLeaves(code, bit):
+            text = leafText[leaf]
+            parts.append(text)
+            if text == '{0000}':
+                return ''.join(parts)
+        return None
+
+    def iterSymbols(self, offset, code):
+        # Like iterDecode, but each dialog is an array('H') of raw leaf codes
+        # (the 16-bit values from the tree bytes, 0 being {0000})
+        if self.tree.raw is None:
+            raise ValueError( "Tree has no raw leaf codes" )
+        leafCodes = self.tree.leafCodes
+        symbols = array('H')
+        base = offset * 8
+        start = base
+        for pos, leaf in self.iterLeaves(code):
+            symbol = leafCodes[leaf]
+            symbols.append(symbol)
+            if symbol == 0:
+                yield (start, symbols)
+                symbols = array('H')
+                start = base + pos
+
+    def decodeSymbols(self, offset, code):
+        return [ {'symbols':symbols,'offset':'0x%04X' % bitOffset}
+                 for bitOffset, symbols in self.iterSymbols(offset, code) ]
+
+def symbolsToText( symbols ):
+    # One lookup per symbol through the shared leaf string table
+    return ''.join([ leafText(c) for c in symbols ])
+
+def decodeTableFor( huff ):
+    # huff can be a HuffTree, a nested list from makeHuffTree or a DecodeTable
+    if isinstance(huff, DecodeTable):
+        return huff
+    if isinstance(huff, HuffTree):
+        return huff.decodeTable()
+    return DecodeTable( huff )
 
-    # Calculate the root node
-    lByte = rawHuff[ raw_length - 2 ] + ( rawHuff[ raw_length - 1 ] << 8 )
-    rootNode = 1 + lByte - 0x8000
+def decodeHuffman( offset, code, huff ):
+    return decodeTableFor( huff ).decode( offset, code )
 
-    root[0] = parseTree( 0, half, rootNode,  rawHuff )
-    root[1] = parseTree( 1, half, rootNode,  rawHuff )
+def iterDecodeHuffman( offset, code, huff ):
+    # Streaming decodeHuffman: (bitOffset, text) pairs with an int offset
+    return decodeTableFor( huff ).iterDecode( offset, code )
 
-    return root
+def decodeAt( offset, code, huff, bitOffset ):
+    return decodeTableFor( huff ).decodeAt( code, bitOffset, offset )
 
-def decodeHuffman( offset, code, huff ):
-    dText = ""
-    dialog = []
-    tempTree = huff
-    byte_idx = 0
-    start = offset
-    startBit = 0
-    for byte in code:
-        # Count down from the end
-        for i in range(8):
-            # extremely confusing bit of logic, but it just checks if the bit is a 1 or a 0
-            code = 1 if (byte & (1 << i) > 0) else 0
-            # if we have a list we have to go further...
-            if( type(tempTree[code]) == list ):
-                tempTree = tempTree[code]
-            else:
-                dText = ''.join([dText,tempTree[code]])
-                if( tempTree[code] == '{0000}' ):
-                    bitOffset = start * 8 + startBit
-                    dialog.append( {'text':dText,'offset':'0x%04X' % bitOffset} ) 
-                    dText = ""
-                    start = byte_idx + offset
-                    startBit = i+1
-                tempTree = huff
-        byte_idx += 1
-    return dialog
+def decodeSymbols( offset, code, huff ):
+    # decodeHuffman without building strings: 'symbols' is an array('H') of
+    # raw leaf codes per dialog, ending with 0 ({0000}). Use symbolsToText
+    # to get the text of the dialogs that need it.
+    return decodeTableFor( huff ).decodeSymbols( offset, code )
 
-def genFreqTable( text ):
-    ft = {}
-    isControl = False
-    ctrlBuff = ''
-    for char in text:
-        if char == '{':
-            isControl = True
-            continue
-        elif char == '}':
-            isControl = False
-            if ctrlBuff in ft:
-                ft[ctrlBuff] += 1
-            else:
-                ft[ctrlBuff] = 1
-            ctrlBuff = ''
-            continue
-        
-        if isControl:
-            ctrlBuff += char
-            continue
+def iterDecodeSymbols( offset, code, huff ):
+    return decodeTableFor( huff ).iterSymbols( offset, code )
 
-        if char in ft:
-            ft[char] += 1
-        else:
-            ft[char] = 1
-    return ft
+class SymbolTable(dict):
+    """Process-wide symbol -> id table, new symbols get the next id.
+
+    Control tokens are stored by their inner hex ('7f04'), everything else by
+    the character itself, the same keys genFreqTable always produced.
+    """
+    def __init__(self):
+        super().__init__()
+        self.symbols = []
+
+    def __missing__(self, symbol):
+        idx = len(self.symbols)
+        self.symbols.append(symbol)
+        self[symbol] = idx
+        return idx
+
+symbolIds = SymbolTable()
+ctrlPattern = re.compile(r'\{([^{}]*)\}')
+
+def tokenize( text ):
+    # split() alternates plain text and the inside of each {xxxx}
+    ids = array('I')
+    getId = symbolIds.__getitem__
+    parts = ctrlPattern.split( text )
+    for i in range(0, len(parts), 2):
+        ids.extend( map(getId, parts[i]) )
+        if i + 1 < len(parts):
+            ids.append( getId(parts[i+1]) )
+    return ids
+
+def freqTable( ids ):
+    # Symbols come out in first-seen order, which buildHuffNodes relies on
+    symbols = symbolIds.symbols
+    return { symbols[i]:n for i, n in Counter(ids).items() }
+
+def genFreqTable( text ):
+    return freqTable( tokenize(text) )
+
+def writeSymbols( writer, ids, codeList ):
+    symbols = symbolIds.symbols
+    for i in ids:
+        code = codeList.get( symbols[i] )
+        if code is None:
+            symbol = symbols[i]
+            if len(symbol) == 1:
+                raise KeyError(f'Caractere {repr(symbol)} não encontrado na árvore Huffman')
+            raise KeyError(f'Control token {{{symbol}}} não encontrado na árvore')
+        writer.write( *code )
 
 def createNode( ft, num ):
     # Get the first minimum
@@ -108,21 +523,66 @@ def createNode( ft, num ):
     ft[num] = min1v + min2v
     return [ft,node]
 
+def buildHuffNodes( ft ):
+    # Same merges as calling createNode until one entry is left, but with a
+    # heap instead of two min() scans per merge. Ties go to the entry that has
+    # been in the table longest (symbols in ft order, then merged nodes in the
+    # order they were made), which is exactly what min() over the dict picked,
+    # so the nodes and the tree from encTree come out byte-identical.
+    heap = [(v, seq, k) for seq, (k, v) in enumerate(ft.items())]
+    if not heap:
+        raise ValueError("Cannot build a Huffman tree from an empty table")
+    heapq.heapify(heap)
+    seq = len(heap)
+    nodes = {}
+    nn = 0
+    while len(heap) > 1:
+        min1v, _, min1k = heapq.heappop(heap)
+        min2v, _, min2k = heapq.heappop(heap)
+        nodes[nn] = {min1k:min1v,min2k:min2v}
+        heapq.heappush(heap, (min1v + min2v, seq, nn))
+        seq += 1
+        nn += 1
+    rootv, _, rootk = heap[0]
+    return [{rootk:rootv}, nodes]
+
+class BitWriter:
+    """Packs Huffman codes LSB first, the bit order decodeHuffman reads.
+
+    Codes are (code, length) pairs where bit 0 of code is the first bit of
+    the symbol. Bits collect in a small int and are moved to the bytearray a
+    few bytes at a time, so writing n codes stays linear.
+    """
+    def __init__(self):
+        self.data = bytearray()
+        self.acc = 0
+        self.bits = 0
+
+    def write(self, code, length):
+        self.acc |= code << self.bits
+        self.bits += length
+        if self.bits >= 64:
+            n = self.bits >> 3
+            self.data += (self.acc & ((1 << (n*8)) - 1)).to_bytes(n, byteorder='little')
+            self.acc >>= n*8
+            self.bits -= n*8
+
+    def bitLength(self):
+        return len(self.data)*8 + self.bits
+
+    def getBytes(self, align=4):
+        # Pad with zero bits to a whole byte, then with zero bytes to align
+        data = bytearray(self.data)
+        data += self.acc.to_bytes((self.bits + 7) >> 3, byteorder='little')
+        while len(data) % align != 0:
+            data.append(0)
+        return data
+
 def bitStr2Bytes(s):
-    l = int( len(s) / 8 + (0 if (len(s) % 8 == 0) else 1) )
-    while l % 4 != 0:
-        l += 1
-    
-    data = bytearray(l)
-    lh = len(s)
-
-    for i in range(0,lh,8):
-        bits = s[i:min(lh,i+8)]
-        while len(bits) != 8:
-            bits += '0'
-        v = int(bits[::-1],2)
-        data[int(i/8)] = v
-    return data
+    writer = BitWriter()
+    if s:
+        writer.write( int(s[::-1],2), len(s) )
+    return writer.getBytes()
 
 def encTree( node, offset, tree, nodeNum=None ):
     # if we're the root node
@@ -160,17 +620,9 @@ def encTree( node, offset, tree, nodeNum=None ):
             tree[idx2+1] = val[1]
     return tree
 
-def encodeHuffman( text ):
-    huffTree = ""
-    nodes = {}
-    # Generate character frequency table
-    ft = genFreqTable( text )
-
+def buildHuffTree( ft ):
     # Create nodes using min-heap
-    nn = 0
-    while len(ft) != 1:
-        ft, nodes[nn] = createNode(ft, nn)
-        nn += 1
+    ft, nodes = buildHuffNodes( ft )
 
     # Building Huffman Tree (using recursion)
     def unpack(branch):
@@ -192,126 +644,262 @@ def encodeHuffman( text ):
     #print(test)
 
     # Create codes for each character
-    def traverse(branch, curCode):
+    def traverse(branch, curCode, curLen):
         codeList = {}
         stem = [*branch]
+        right = curCode | (1 << curLen)
         if type(stem[0]) == int:
-            codeList.update( traverse( branch[stem[0]], curCode+'0' ) )
+            codeList.update( traverse( branch[stem[0]], curCode, curLen+1 ) )
         else:
-            codeList[stem[0]] = curCode + '0'
+            codeList[stem[0]] = (curCode, curLen+1)
 
         if type(stem[1]) == int:
-            codeList.update( traverse( branch[stem[1]], curCode+'1' ) )
+            codeList.update( traverse( branch[stem[1]], right, curLen+1 ) )
         else:
-            codeList[stem[1]] = curCode + '1'
+            codeList[stem[1]] = (right, curLen+1)
         return codeList
-    codeList = traverse( list(ft.values())[0], '' )
-    
+    codeList = traverse( list(ft.values())[0], 0, 0 )
+
+    return [tree, codeList]
+
+def encodeHuffman( text ):
+    # Generate character frequency table
+    ids = tokenize( text )
+    tree, codeList = buildHuffTree( freqTable( ids ) )
+
     # Actually encode the string with our new codes
-    huffmanStr = ''
-    isControl = False
-    ctrlBuff = ''
-    for char in text:
-        if char == '{':
-            isControl = True
-            continue
-        elif char == '}':
-            isControl = False
-            huffmanStr += codeList[ctrlBuff]
-            ctrlBuff = ''
-            continue
-        if isControl:
-            ctrlBuff += char
-            continue
-        huffmanStr += codeList[char]
-    huffmanCode = bitStr2Bytes( huffmanStr )
+    writer = BitWriter()
+    writeSymbols( writer, ids, codeList )
+    huffmanCode = writer.getBytes()
 
     return [huffmanCode, tree]
 
+def huffCodeBits( ft ):
+    # Total length in bits of text coded with a Huffman tree for ft: every
+    # merge adds one bit to each symbol under it, i.e. the merged weight.
+    # Any Huffman tree has the same total, so tie-breaking doesn't matter.
+    heap = list( ft.values() )
+    if len(heap) < 2:
+        raise ValueError("Cannot build a Huffman tree with fewer than two symbols")
+    heapq.heapify(heap)
+    bits = 0
+    while len(heap) > 1:
+        merged = heapq.heappop(heap) + heapq.heappop(heap)
+        bits += merged
+        heapq.heappush(heap, merged)
+    return bits
+
+def paddedSize( bits, align=4 ):
+    # Bytes BitWriter.getBytes produces for this many bits
+    size = (bits + 7) >> 3
+    return size + (-size % align)
+
+# Leaf values are cached so unmapped characters only warn once
+leafCodeCache = {}
+
+def leafCode( symbol ):
+    # The 16-bit leaf value encTree writes for a symbol
+    code = leafCodeCache.get( symbol )
+    if code is None:
+        if len(symbol) == 4:
+            code = int(symbol,16)
+        else:
+            val = encodeShiftJIS( symbol )
+            code = val[0] + (val[1] << 8)
+        leafCodeCache[symbol] = code
+    return code
+
+def foldAliases( ft ):
+    # Symbols that end up as the same leaf ('A' and 'Ａ', or every unmapped
+    # ASCII character, which all become a space) only need one node. Returns
+    # the folded table and symbol -> kept symbol for the ones folded away.
+    folded = {}
+    aliases = {}
+    kept = {}
+    for symbol, n in ft.items():
+        rep = kept.setdefault( leafCode(symbol), symbol )
+        folded[rep] = folded.get(rep, 0) + n
+        if rep != symbol:
+            aliases[symbol] = rep
+    return [folded, aliases]
+
+def encodeHuffmanOptimal( text ):
+    # Smallest code + tree for this format. The tree costs 4 bytes per node
+    # whatever the code lengths are, so for a given set of leaves Huffman is
+    # already optimal; the only saving left is not spending nodes on
+    # duplicate leaves. Decodes to exactly what encodeHuffman's output does.
+    ids = tokenize( text )
+    ft, aliases = foldAliases( freqTable( ids ) )
+    tree, codeList = buildHuffTree( ft )
+    for symbol, rep in aliases.items():
+        codeList[symbol] = codeList[rep]
+
+    writer = BitWriter()
+    writeSymbols( writer, ids, codeList )
+    return [writer.getBytes(), tree]
+
+def encodedSize( text, huff_tree=None, optimal=False ):
+    # [code bytes, tree bytes] that encodeHuffman (huff_tree=None),
+    # encodeHuffmanOptimal (optimal=True) or encodeWithTree would produce,
+    # without building either. A new tree is 4 bytes per node plus the 2
+    # byte terminator; a reused one costs 0.
+    ids = tokenize( text )
+    ft = freqTable( ids )
+    if huff_tree is None:
+        if optimal:
+            ft = foldAliases( ft )[0]
+        return [paddedSize( huffCodeBits(ft) ), 4*(len(ft) - 1) + 2]
+
+    if isinstance(huff_tree, (bytes, bytearray, memoryview)):
+        huff_tree = treePool.get(huff_tree)
+    code_map = codeMapCache.get(huff_tree)
+    bits = 0
+    for symbol, n in ft.items():
+        code = code_map.get( symbol )
+        if code is None:
+            if len(symbol) == 1:
+                raise KeyError(f'Caractere {repr(symbol)} não encontrado na árvore Huffman')
+            raise KeyError(f'Control token {{{symbol}}} não encontrado na árvore')
+        bits += n * code[1]
+    return [paddedSize( bits ), 0]
+
+def encodeHuffmanBlock( dialogs, offset=0, optimal=False ):
+    # Encode every dialog of a TextBlock with one tree built from their
+    # combined frequencies. Returns the packed code, the tree and the bit
+    # offset of each dialog, counted the way decodeHuffman does (offset is
+    # the byte position of the code in the block, huff_c for a TextBlock).
+    # The code and tree are the same as encodeHuffman( ''.join(dialogs) ),
+    # or encodeHuffmanOptimal with optimal=True.
+    terminator = symbolIds['0000']
+    dialogIds = []
+    ids = array('I')
+    for text in dialogs:
+        tokens = tokenize( text )
+        if not tokens or tokens[-1] != terminator:
+            raise ValueError( "Dialog does not end with {0000}: %r" % text[-20:] )
+        dialogIds.append( tokens )
+        ids.extend( tokens )
+
+    ft = freqTable( ids )
+    aliases = {}
+    if optimal:
+        ft, aliases = foldAliases( ft )
+    tree, codeList = buildHuffTree( ft )
+    for symbol, rep in aliases.items():
+        codeList[symbol] = codeList[rep]
+
+    writer = BitWriter()
+    offsets = []
+    for tokens in dialogIds:
+        offsets.append( offset*8 + writer.bitLength() )
+        writeSymbols( writer, tokens, codeList )
+
+    return [writer.getBytes(), tree, offsets]
+
+
+def _iter_tree_codes(huff_tree):
+    """Percorre as folhas de uma HuffTree (ou da lista de makeHuffTree) e gera (símbolo, código, tamanho).
+
+    O código é LSB-first (bit 0 = primeiro bit lido). A ordem (esquerda antes da direita)
+    é a mesma da versão recursiva antiga, então símbolos repetidos terminam com o último
+    código visitado, como antes.
+    """
+    if not isinstance(huff_tree, HuffTree):
+        huff_tree = HuffTree.fromList(huff_tree)
+    children = huff_tree.children
+    leafText = huff_tree.leafText
+
+    stack = [(0, 0, 0)] if len(children) else []
+    while stack:
+        node, code, length = stack.pop()
+        if node < 0:
+            yield leafText[~node], code, length
+            continue
+        for bit in (1, 0):
+            child = children[(node << 1) | bit]
+            if child & HuffTree.LEAF:
+                child = ~(child & 0x7FFF)
+            stack.append((child, code | (bit << length), length + 1))
 
-def _build_code_map_from_tree(huff_tree):
-    """Retorna um dicionário símbolo -> bitstring a partir da estrutura retornada por makeHuffTree."""
+
+def _build_code_pairs_from_tree(huff_tree):
+    """Retorna um dicionário símbolo -> (código, tamanho) no formato usado pelo BitWriter."""
     code_map = {}
+    for key, code, length in _iter_tree_codes(huff_tree):
+        # normalizar chaves de controle: '{7f04}' -> '7f04'
+        if isinstance(key, str) and key.startswith('{') and key.endswith('}'):
+            code_map[key[1:-1]] = (code, length)
+        code_map[key] = (code, length)
+    return code_map
 
-    def walk(node, prefix):
-        # node é uma lista [left, right]
-        if type(node) != list:
-            return
-        left = node[0]
-        right = node[1]
 
-        # left
-        if type(left) == list:
-            walk(left, prefix + '0')
-        else:
-            key = left
-            # normalizar chaves de controle: '{7f04}' -> '7f04'
-            if isinstance(key, str) and key.startswith('{') and key.endswith('}'):
-                inner = key[1:-1]
-                code_map[inner] = prefix + '0'
-                code_map[key] = prefix + '0'
-            else:
-                code_map[key] = prefix + '0'
+def _build_code_map_from_tree(huff_tree):
+    """Retorna um dicionário símbolo -> bitstring a partir de uma HuffTree (ou da lista de makeHuffTree)."""
+    return {key: format(code, '0%db' % length)[::-1] if length else ''
+            for key, (code, length) in _build_code_pairs_from_tree(huff_tree).items()}
 
-        # right
-        if type(right) == list:
-            walk(right, prefix + '1')
-        else:
-            key = right
-            if isinstance(key, str) and key.startswith('{') and key.endswith('}'):
-                inner = key[1:-1]
-                code_map[inner] = prefix + '1'
-                code_map[key] = prefix + '1'
-            else:
-                code_map[key] = prefix + '1'
 
-    # huff_tree pode ser root = [left,right]
-    walk(huff_tree, '')
-    return code_map
+class CodeMapCache:
+    """LRU de mapas de código (símbolo -> (código, tamanho)) por árvore.
+
+    A chave é o hash dos bytes brutos da árvore (HuffTree.digest), então
+    todos os diálogos de um TextBlock compartilham o mesmo mapa. Árvores sem
+    bytes brutos (montadas a partir de listas) não entram no cache.
+    """
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self.maps = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, huff_tree):
+        key = huff_tree.digest() if isinstance(huff_tree, HuffTree) else None
+        if key is not None and key in self.maps:
+            self.maps.move_to_end(key)
+            self.hits += 1
+            return self.maps[key]
+        self.misses += 1
+        code_map = _build_code_pairs_from_tree(huff_tree)
+        if key is not None:
+            self.put(key, code_map)
+        return code_map
+
+    def put(self, key, code_map):
+        """Guarda um mapa já montado (ex.: lido do TreeCache) como o mais recente."""
+        self.maps[key] = code_map
+        self.maps.move_to_end(key)
+        while len(self.maps) > self.maxsize:
+            self.maps.popitem(last=False)
+
+    def clear(self):
+        self.maps.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'size': len(self.maps), 'maxsize': self.maxsize}
+
+codeMapCache = CodeMapCache()
 
 
 def encodeWithTree(huff_tree, text):
-    """Encode o texto usando a árvore Huffman existente (huff_tree é a estrutura retornada por makeHuffTree).
+    """Encode o texto usando a árvore Huffman existente.
 
+    huff_tree pode ser uma HuffTree, os bytes brutos da árvore ou a lista de makeHuffTree.
+    Bytes brutos passam pelo treePool (chave: hash dos bytes), então a árvore só é
+    parseada e o mapa de códigos do codeMapCache só é montado uma vez por árvore.
     Retorna bytes codificados (bit-packed) - lança KeyError se algum símbolo não existir na árvore.
     """
-    code_map = _build_code_map_from_tree(huff_tree)
-
-    # construir bitstring semelhante a encodeHuffman
-    huffmanStr = ''
-    isControl = False
-    ctrlBuff = ''
-    for ch in text:
-        if ch == '{':
-            isControl = True
-            ctrlBuff = ''
-            continue
-        elif ch == '}':
-            isControl = False
-            # key é ctrlBuff (sem chaves)
-            if ctrlBuff not in code_map:
-                # tentar com chaves
-                key = '{' + ctrlBuff + '}'
-                if key not in code_map:
-                    raise KeyError(f'Control token {{{ctrlBuff}}} não encontrado na árvore')
-                huffmanStr += code_map[key]
-            else:
-                huffmanStr += code_map[ctrlBuff]
-            ctrlBuff = ''
-            continue
-
-        if isControl:
-            ctrlBuff += ch
-            continue
+    if isinstance(huff_tree, (bytes, bytearray, memoryview)):
+        huff_tree = treePool.get(huff_tree)
+    code_map = codeMapCache.get(huff_tree)
 
-        # normal char
-        if ch not in code_map:
-            # tentar variantes (às vezes a árvore tem a forma de string diferente)
-            raise KeyError(f'Caractere {repr(ch)} não encontrado na árvore Huffman')
-        huffmanStr += code_map[ch]
+    writer = BitWriter()
+    writeSymbols(writer, tokenize(text), code_map)
 
-    # converter para bytes
-    huffmanCode = bitStr2Bytes(huffmanStr)
+    # converter para bytes (alinhado em 4 bytes)
+    huffmanCode = writer.getBytes()
     return huffmanCode
 
 '''
@@ -1,3 +1,5 @@
+import os
+import mmap
 from libs.blockDefs import *
 
 '''
@@ -18,7 +20,11 @@ if __name__ == '__main__':
 
 
 # Generators for Parsing Blocks
-def parseHBD1(filename, yield_invalid=False):
+def parseHBD1(filename, yield_invalid=False, zeroCopy=False):
+    if zeroCopy:
+        yield from parseHBD1Mapped(filename, yield_invalid)
+        return
+
     with open(filename, "rb") as dq4b:
         # Nothing useful to us in the first sector
         if yield_invalid:
@@ -37,7 +43,8 @@ def parseHBD1(filename, yield_invalid=False):
             b.parseHeader(dq4b.read(16))
             b.offset = dq4b.tell()-16
 
-            if b.numSubBlocks > 1000 or b.zeroBytes != 0:
+            # A header with no sectors would never move us forward
+            if b.numSubBlocks > 1000 or b.zeroBytes != 0 or (b.sectors == 0 and b.length != 0):
                 b.data = dq4b.read(2048-16)
                 b.valid = False
                 blockid += 1
@@ -59,14 +66,69 @@ def parseHBD1(filename, yield_invalid=False):
             blockid += 1
             yield b
 
+def parseHBD1Mapped(filename, yield_invalid=False):
+    # parseHBD1 over a memory map: headers are unpacked in place and
+    # Block.data is a memoryview of the file, so nothing is copied. The
+    # views are only valid while the generator is alive; copy what you keep.
+    with open(filename, "rb") as dq4b:
+        size = os.fstat(dq4b.fileno()).st_size
+        if size == 0:
+            return
+        mm = mmap.mmap(dq4b.fileno(), 0, access=mmap.ACCESS_READ)
+    view = memoryview(mm)
+    try:
+        pos = 0
+        blockid = 0
+        last = False
+        while not last:
+            b = Block(blockid)
+            if pos + 16 <= size:
+                b.parseHeaderFrom(mm, pos)
+                b.offset = pos
+            else:
+                # Short read at the end of the file, same as parseHBD1
+                b.parseHeader(mm[pos:pos+16])
+                b.offset = size-16
+            start = min(pos+16, size)
+
+            if blockid == 0:
+                # Nothing useful to us in the first sector
+                b.valid = False
+                end = start+2048-16
+            elif b.numSubBlocks > 1000 or b.zeroBytes != 0 or (b.sectors == 0 and b.length != 0):
+                b.valid = False
+                end = start+2048-16
+            elif b.length == 0:
+                b.valid = False
+                end = size
+                last = True
+            else:
+                end = start+2048*b.sectors-16
+            end = min(end, size)
+            b.data = view[start:end]
+
+            if b.valid or yield_invalid:
+                yield b
+            pos = end
+            blockid += 1
+    finally:
+        view.release()
+        try:
+            mm.close()
+        except BufferError:
+            # Someone still holds a view, the map goes away with it
+            pass
+
 def parseBlock(block):
     dataOffset = block.numSubBlocks*16
-    lengths = []
+    off = dataOffset
     for i in range(block.numSubBlocks):
         sb = SubBlock(i+1) # no need to zero-index this
-        sb.parseHeader( block.data[(i*16):((i+1)*16)] )
-        off = dataOffset+sum(lengths)
+        if (i+1)*16 <= len(block.data):
+            sb.parseHeaderFrom( block.data, i*16 )
+        else:
+            sb.parseHeader( block.data[(i*16):((i+1)*16)] )
         sb.offset = off + block.offset
         sb.data = block.data[off:off+sb.compLength]
-        lengths.append(sb.compLength)
-        yield sb
\ No newline at end of file
+        off += sb.compLength
+        yield sb
@@ -0,0 +1,35 @@
+import os
+import struct
+
+# Fixed-size record files tied to a ROM
+#
+# A 28 byte header (magic, version, ROM content hash, record count) followed
+# by the records back to back, all in one struct format. Used by the dialog
+# index and the script reference index; the hash is libs.hbd1index.romHash.
+
+FILE_HEADER = struct.Struct('<4sI16sI')
+
+def saveRecords(path, magic, version, romHash, record, records):
+    buffer = bytearray( FILE_HEADER.pack( magic, version, romHash, len(records) ) )
+    for rec in records:
+        buffer.extend( record.pack( *rec ) )
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as fh:
+        fh.write( buffer )
+    os.replace( tmp, path )
+
+def loadRecords(path, magic, version, record, romHash=None):
+    # Returns (romHash, record tuples), or None if the file is missing,
+    # damaged or (when romHash is given) was built from another ROM
+    try:
+        with open(path, 'rb') as fh:
+            data = fh.read()
+        _magic, _version, _hash, count = FILE_HEADER.unpack_from( data, 0 )
+    except (OSError, struct.error):
+        return None
+    if _magic != magic or _version != version or \
+       len(data) != FILE_HEADER.size + count*record.size:
+        return None
+    if romHash is not None and romHash != _hash:
+        return None
+    return _hash, record.iter_unpack( data[FILE_HEADER.size:] )
@@ -0,0 +1,115 @@
+import mmap
+import struct
+from collections import namedtuple
+from libs.lzs import decompress
+from libs.hbd1index import HBD1Index
+from libs.recordfile import saveRecords, loadRecords
+
+# Index of c021a0 dialog references in the script (type 39) sub-blocks
+#
+# Every script sub-block listed by HBD1Index is read once from an mmap
+# (LZS decompressed when flags == 1280, as ScriptBlock does) and each c021a0
+# reference is recorded with the script it lives in and its byte position in
+# the script data. The arguments are the 16-bit dialog offset and the dialog
+# number shifted left by 4 (see ScriptBlock.replaceOffset). Saved next to the
+# ROM as <rom>.refs and tied to the ROM content hash.
+
+DIALOG_REF = b'\xc0\x21\xa0'
+SCRIPT_TYPE = 39
+MAGIC = b'DQSR'
+VERSION = 1
+
+RECORD = struct.Struct('<IIIHHB')
+
+# subBlock is the HBD1Index sub-block id, position is relative to the
+# (decompressed) script data, nibble the low 4 bits of the dialog argument
+ScriptRef = namedtuple('ScriptRef', 'subBlock bodyOffset position dialog offset nibble')
+
+def iterDialogRefs(raw):
+    # (position, offset, dialog, nibble) for every c021a0 with room for its
+    # two arguments
+    pos = raw.find( DIALOG_REF )
+    while pos != -1 and pos + 7 <= len(raw):
+        offset = raw[pos+3] | (raw[pos+4] << 8)
+        arg = raw[pos+5] | (raw[pos+6] << 8)
+        yield pos, offset, arg >> 4, arg & 0xF
+        pos = raw.find( DIALOG_REF, pos+1 )
+
+class ScriptRefIndex:
+    def __init__(self, romHash=b''):
+        self.romHash = romHash
+        self.refs = []
+        self.byKey = {}
+        self.bySubBlock = {}
+
+    def __len__(self):
+        return len(self.refs)
+
+    @classmethod
+    def open(cls, romPath, refsPath=None, index=None):
+        # Load <rom>.refs, rebuilding it when missing or made from another ROM
+        refsPath = refsPath or romPath + '.refs'
+        index = index or HBD1Index.open( romPath )
+        refs = cls.load( refsPath, index.hash )
+        if refs is None:
+            refs = cls.build( romPath, index )
+            refs.save( refsPath )
+        return refs
+
+    @classmethod
+    def build(cls, romPath, index=None):
+        index = index or HBD1Index.open( romPath )
+        refs = cls( index.hash )
+        scripts = index.subBlocksOfType( SCRIPT_TYPE )
+        if not scripts:
+            return refs
+        with open(romPath, 'rb') as fh, mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            for sb in scripts:
+                data = mm[sb.bodyOffset:sb.bodyOffset + sb.compLength]
+                if sb.flags == 1280:
+                    data = decompress( data, sb.length )
+                for pos, offset, dialog, nibble in iterDialogRefs( data ):
+                    refs.add( sb.id, sb.bodyOffset, pos, dialog, offset, nibble )
+        return refs
+
+    def add(self, subBlock, bodyOffset, position, dialog, offset, nibble):
+        ref = ScriptRef( subBlock, bodyOffset, position, dialog, offset, nibble )
+        self.refs.append( ref )
+        self.byKey.setdefault( (dialog, offset), [] ).append( ref )
+        self.bySubBlock.setdefault( subBlock, [] ).append( ref )
+        return ref
+
+    # Lookups
+    def find(self, dialog, offset):
+        # Every reference to this dialog offset, in ROM order
+        return self.byKey.get( (dialog, offset), [] )
+
+    def inSubBlock(self, subBlock):
+        return self.bySubBlock.get( subBlock, [] )
+
+    def fixups(self, offsets):
+        # Groups {(dialog, oldOff): newOff} by script sub-block, ready for
+        # ScriptBlock.replaceOffsets. Returns [bySubBlock, missing keys].
+        bySubBlock = {}
+        missing = []
+        for key, newOff in offsets.items():
+            refs = [ref for ref in self.byKey.get( key, [] ) if ref.nibble == 0]
+            if not refs:
+                missing.append( key )
+            for ref in refs:
+                bySubBlock.setdefault( ref.subBlock, {} )[key] = newOff
+        return [bySubBlock, missing]
+
+    def save(self, path):
+        saveRecords( path, MAGIC, VERSION, self.romHash, RECORD, self.refs )
+
+    @classmethod
+    def load(cls, path, romHash=None):
+        loaded = loadRecords( path, MAGIC, VERSION, RECORD, romHash )
+        if loaded is None:
+            return None
+        _hash, records = loaded
+        refs = cls( _hash )
+        for rec in records:
+            refs.add( *rec )
+        return refs
@@ -0,0 +1,92 @@
+import os
+import sys
+import marshal
+from libs.huffman import HuffTree, codeMapCache
+
+# Directory cache of parsed Huffman trees for warm starts
+#
+# Each tree is one marshal file named after the hash of its raw bytes, holding
+# the flat tree, its decode lookup table (once it has been used to decode) and its code
+# map. Files live under a versioned directory, so changing the layout just
+# means bumping VERSION. The total size is capped; the least recently used
+# files (by mtime, touched on every load) are evicted first.
+
+VERSION = 2
+
+class TreeCache:
+    def __init__(self, root, maxBytes=64*1024*1024):
+        self.root = root
+        self.dir = os.path.join( root, 'v%d' % VERSION )
+        self.maxBytes = maxBytes
+        self.loads = 0
+        self.saves = 0
+        os.makedirs( self.dir, exist_ok=True )
+
+    def path(self, digest, strict):
+        return os.path.join( self.dir, digest.hex() + ('' if strict else '-lax') + '.bin' )
+
+    def load(self, digest, strict=True):
+        path = self.path( digest, strict )
+        try:
+            with open(path, 'rb') as fh:
+                version, byteorder, state, codeMap = marshal.load(fh)
+            if version != VERSION or byteorder != sys.byteorder:
+                return None
+            tree = HuffTree.load( state )
+        except (OSError, EOFError, ValueError, TypeError):
+            return None
+
+        # Mark as recently used
+        os.utime( path )
+        tree.key = digest
+        tree.cachedEntries = len(state[5])
+        if codeMap is not None and digest not in codeMapCache.maps:
+            codeMapCache.put( digest, codeMap )
+        self.loads += 1
+        return tree
+
+    def save(self, tree, strict=True):
+        # Only write trees that are new or have gained a decode table
+        digest = tree.digest()
+        if digest is None:
+            return False
+        entries = len(tree.table.lookup) if tree.table is not None else 0
+        path = self.path( digest, strict )
+        if tree.cachedEntries == entries and os.path.exists(path):
+            return False
+
+        data = marshal.dumps( (VERSION, sys.byteorder, tree.dump(), codeMapCache.maps.get(digest)) )
+        tmp = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp, 'wb') as fh:
+            fh.write( data )
+        os.replace( tmp, path )
+        tree.cachedEntries = entries
+        self.saves += 1
+        return True
+
+    def evict(self):
+        files = []
+        total = 0
+        for name in os.listdir( self.dir ):
+            if not name.endswith('.bin'):
+                continue
+            path = os.path.join( self.dir, name )
+            try:
+                st = os.stat( path )
+            except OSError:
+                continue
+            files.append( (st.st_mtime, st.st_size, path) )
+            total += st.st_size
+
+        removed = 0
+        files.sort()
+        for mtime, size, path in files:
+            if total <= self.maxBytes:
+                break
+            try:
+                os.remove( path )
+            except OSError:
+                continue
+            total -= size
+            removed += 1
+        return removed
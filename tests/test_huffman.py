@@ -0,0 +1,49 @@
+import os
+import sys
+import unittest
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, ROOT)
+
+from libs.huffman import HuffTree, parseTree, encodeHuffman, decodeHuffman
+
+def recursiveTree( rawHuff ):
+    # The nested list the original recursive makeHuffTree built
+    raw = bytes(rawHuff)[:-2]
+    half = len(raw) // 2
+    rootNode = 1 + raw[-2] + ( raw[-1] << 8 ) - 0x8000
+    return [ parseTree( 0, half, rootNode, raw ), parseTree( 1, half, rootNode, raw ) ]
+
+class SharedNodeTest(unittest.TestCase):
+    def setUp(self):
+        self.code, self.tree = encodeHuffman( 'アイウエオカキクケコ{0000}アイウ{0000}' )
+
+    def pointerSlots(self, raw):
+        # Slots holding a node pointer, without the root pointer at the end
+        return [i for i in range(0, len(raw) - 4, 2) if (raw[i+1] & 0xF0) == 0x80]
+
+    def test_shared_node(self):
+        raw = bytearray( self.tree )
+        shared = 0
+        for a in self.pointerSlots( raw ):
+            for b in self.pointerSlots( raw ):
+                if a == b:
+                    continue
+                patched = bytearray( raw )
+                patched[a:a+2] = raw[b:b+2]
+                try:
+                    expected = recursiveTree( patched )
+                except RecursionError:
+                    # Node inside its own subtree
+                    with self.assertRaises( ValueError ):
+                        HuffTree( patched )
+                    continue
+                tree = HuffTree( patched )
+                self.assertEqual( tree.toList(), expected )
+                self.assertEqual( decodeHuffman( 0x18, self.code, tree ),
+                                  decodeHuffman( 0x18, self.code, expected ) )
+                shared += 1
+        self.assertGreater( shared, 0 )
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+import os
+import sys
+import struct
+import tempfile
+import unittest
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, ROOT)
+
+from libs.parsing import parseHBD1, parseBlock
+
+def block(subBlocks, sectors=None):
+    # One block: header, sub-block headers, bodies, padded to whole sectors
+    hdr = b''.join( struct.pack('<IIIHH', len(data), len(data), 0, 0, _type)
+                    for data, _type in subBlocks )
+    body = b''.join( data for data, _type in subBlocks )
+    total = 16 + len(hdr) + len(body)
+    count = (total + 2047) // 2048
+    blk = struct.pack('<IIII', len(subBlocks), count if sectors is None else sectors, total, 0)
+    blk += hdr + body
+    return blk + bytes(count*2048 - len(blk))
+
+class ZeroSectorTest(unittest.TestCase):
+    def setUp(self):
+        # First sector, a block claiming 0 sectors, a good block, end marker
+        data = bytes(2048)
+        data += block( [(b'\x11' * 100, 7)], sectors=0 )
+        data += block( [(b'\x22' * 3000, 39), (b'\x33' * 40, 7)] )
+        data += bytes(16)
+        fh, self.path = tempfile.mkstemp( suffix='.Q41' )
+        with os.fdopen(fh, 'wb') as out:
+            out.write( data )
+
+    def tearDown(self):
+        os.remove( self.path )
+
+    def walk(self, zeroCopy, yieldInvalid):
+        blocks = []
+        for b in parseHBD1( self.path, yieldInvalid, zeroCopy=zeroCopy ):
+            subs = [(sb.type, bytes(sb.data)) for sb in parseBlock(b)] if b.valid else []
+            blocks.append( (b.offset, b.valid, b.sectors, bytes(b.data), subs) )
+            self.assertLess( len(blocks), 10 )
+        return blocks
+
+    def test_zero_sectors(self):
+        for yieldInvalid in (False, True):
+            blocks = self.walk( False, yieldInvalid )
+            self.assertEqual( self.walk( True, yieldInvalid ), blocks )
+
+        valid = [b for b in self.walk( True, False )]
+        self.assertEqual( [b[0] for b in valid], [4096] )
+        self.assertEqual( [t for t, d in valid[0][4]], [39, 7] )
+
+        blocks = self.walk( True, True )
+        self.assertEqual( [(b[0], b[1], b[2]) for b in blocks[:3]],
+                          [(0, False, 0), (2048, False, 0), (4096, True, 2)] )
+
+if __name__ == '__main__':
+    unittest.main()
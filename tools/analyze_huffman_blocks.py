@@ -9,7 +9,7 @@ Estratégia heurística:
 - Para cada offset listado em `tools_output/dq4_address_mapping.csv`, lê uma janela
   a partir do offset (por exemplo 16KB)
 - Procura por possíveis finais de árvore (b'\x00\x00') dentro da janela e tenta
-  interpretar os bytes seguintes/anteriores como árvore via `makeHuffTree`
+  interpretar os bytes seguintes/anteriores como árvore via `parseHuffTree`
 - Usa `decodeHuffman` para validar se o bloco decodifica e contém o terminador `{0000}`
 """
 
@@ -21,7 +21,7 @@ from typing import Optional
 ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
 sys.path.insert(0, ROOT)
 
-from libs.huffman import makeHuffTree, decodeHuffman
+from libs.huffman import parseHuffTree, decodeHuffman
 
 
 MAPPING = os.path.join('tools_output', 'dq4_address_mapping.csv')
@@ -47,12 +47,12 @@ def try_detect_block(qdata: bytes, offset: int, window: int = 0x4000) -> Optiona
         # tentaremos várias posições de início de árvore (pragmaticamente testar)
         # aqui tratamos tree_bytes como possível rawHuff
         try:
-            huff = makeHuffTree(tree_bytes)
+            huff = parseHuffTree(tree_bytes)
         except Exception:
             # não é uma árvore válida
             continue
 
-        # se makeHuffTree não levantou, agora tentamos decodificar - porém decodeHuffman
+        # se parseHuffTree não levantou, agora tentamos decodificar - porém decodeHuffman
         # espera (offset_bits, code_bytes, huff). No caso, o código está após a árvore,
         # mas nossa heurística original armazena dados primeiro e árvore depois. Tentar
         # ambas ordens: data+tree (conhecido no repo: encoded_data + tree)
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark: construção da árvore Huffman (createNode linear x buildHuffNodes com heap)
+
+Monta os alfabetos reais dos blocos a partir do CSV de tradução:
+- Se `tools_output/dq4_address_mapping.csv` existir, os diálogos são agrupados
+  pelo SUBBLOCK_BODY_OFFSET (um grupo = um TextBlock real)
+- Caso contrário, agrupa IDs consecutivos em blocos de --group diálogos
+
+Para cada bloco gera a tabela de frequência, constrói os nós com os dois
+métodos, confere que são idênticos e soma o tempo de cada um.
+"""
+
+import os
+import sys
+import csv
+import time
+import argparse
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, ROOT)
+
+from libs.huffman import genFreqTable, createNode, buildHuffNodes
+
+TRANSLATION_CSV = os.path.join('translation_files', 'dq4_translation_csv.csv')
+ADDRESS_MAP_CSV = os.path.join('tools_output', 'dq4_address_mapping.csv')
+
+
+def load_texts(csv_path, column):
+    """Carrega ID_HEX -> texto da coluna escolhida (1 = japonês, 2 = tradução)."""
+    texts = {}
+    with open(csv_path, 'r', encoding='utf-8', newline='') as f:
+        reader = csv.reader(f, delimiter='|')
+        for row in reader:
+            if len(row) <= column:
+                continue
+            id_hex = row[0].lstrip('﻿').strip().strip('"')
+            if not id_hex or id_hex.upper().startswith('ID_HEX'):
+                continue
+            if row[column]:
+                texts[id_hex] = row[column] + '{0000}'
+    return texts
+
+
+def load_block_groups(csv_path):
+    """Retorna ID_HEX -> SUBBLOCK_BODY_OFFSET a partir do mapeamento de endereços."""
+    groups = {}
+    with open(csv_path, 'r', encoding='utf-8') as f:
+        f.readline()
+        for line in f:
+            parts = line.strip().split('|')
+            if len(parts) >= 6:
+                groups[parts[1].strip()] = parts[4].strip()
+    return groups
+
+
+def block_alphabets(texts, group_size):
+    """Junta os textos de cada bloco e devolve a lista de textos por bloco."""
+    blocks = {}
+    if os.path.exists(ADDRESS_MAP_CSV):
+        groups = load_block_groups(ADDRESS_MAP_CSV)
+        for id_hex, text in texts.items():
+            blocks.setdefault(groups.get(id_hex, id_hex), []).append(text)
+    else:
+        for idx, (id_hex, text) in enumerate(sorted(texts.items())):
+            blocks.setdefault(idx // group_size, []).append(text)
+    return [''.join(parts) for parts in blocks.values()]
+
+
+def build_linear(ft):
+    """Construtor original: dois min() lineares por fusão."""
+    nodes = {}
+    nn = 0
+    while len(ft) != 1:
+        ft, nodes[nn] = createNode(ft, nn)
+        nn += 1
+    return [ft, nodes]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark da construção da árvore Huffman')
+    parser.add_argument('--csv', default=TRANSLATION_CSV, help='CSV de tradução (pipe)')
+    parser.add_argument('--column', type=int, default=1, help='Coluna do texto (1=japonês, 2=tradução)')
+    parser.add_argument('--group', type=int, default=64, help='Diálogos por bloco sem mapeamento')
+    parser.add_argument('--repeat', type=int, default=3, help='Repetições de cada medição')
+    args = parser.parse_args()
+
+    texts = load_texts(args.csv, args.column)
+    blocks = [b for b in block_alphabets(texts, args.group) if b]
+    tables = [genFreqTable(b) for b in blocks]
+    tables = [ft for ft in tables if len(ft) > 1]
+
+    sizes = sorted(len(ft) for ft in tables)
+    print(f'[*] {len(texts):,} textos em {len(tables):,} blocos')
+    print(f'[*] Alfabeto por bloco: min {sizes[0]}, mediana {sizes[len(sizes) // 2]}, max {sizes[-1]}')
+
+    for ft in tables:
+        if build_linear(dict(ft)) != buildHuffNodes(dict(ft)):
+            print('[!] Árvores diferentes entre os dois métodos!')
+            return 1
+    print('[✓] Nós idênticos em todos os blocos')
+
+    timings = {}
+    for name, builder in (('createNode', build_linear), ('buildHuffNodes', buildHuffNodes)):
+        best = None
+        for _ in range(args.repeat):
+            copies = [dict(ft) for ft in tables]
+            start = time.perf_counter()
+            for ft in copies:
+                builder(ft)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        timings[name] = best
+        print(f'  {name:16s} {best:8.3f}s')
+
+    print(f'[✓] Ganho: {timings["createNode"] / timings["buildHuffNodes"]:.1f}x')
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -14,11 +14,24 @@ import os
 import sys
 import json
 import csv
+import mmap
+import zlib
+import argparse
+from concurrent.futures import ProcessPoolExecutor
 from collections import OrderedDict
 from typing import List, Tuple, Dict, Optional
 
-# Magic header que precede cada bloco
-MAGIC_HEADER = b'\x00\x00\x08\x00\x00\x00\x08\x00'
+# Adicionar libs ao path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from libs.huffman import HuffTree, treePool
+from libs.treecache import TreeCache
+from libs.hbd1index import HBD1Index
+from libs.dialogindex import DialogIndex
+
+# Manifesto do modo incremental (CRC32 e IDs de cada text block)
+MANIFEST_JSON = os.path.join('tools_output', 'dq4_extract_manifest.json')
+MANIFEST_VERSION = 1
 
 class HuffmanDecoder:
     """Decodificador Huffman completo para DQ4"""
@@ -32,114 +45,53 @@ class HuffmanDecoder:
             return ''
     
     @staticmethod
-    def parse_tree(switch: int, offset: int, cur_node: int, tree_bytes: bytes) -> any:
+    def make_huff_tree(raw_huff: bytes) -> Optional[HuffTree]:
         """
-        Parseia árvore Huffman recursivamente.
-        
-        Args:
-            switch: 0 para esquerda, 1 para direita
-            offset: Offset base para navegação
-            cur_node: Nó atual
-            tree_bytes: Bytes da árvore Huffman
+        Constrói árvore Huffman a partir dos bytes.
+
+        A árvore é a HuffTree compartilhada de libs.huffman, montada de forma
+        iterativa. Ponteiros fora dos bytes da árvore viram folhas None (como
+        no parser recursivo antigo) em vez de abortar o bloco. Árvores com os
+        mesmos bytes vêm do treePool, parseadas uma única vez.
         """
-        index = cur_node * 2 + (offset if switch else 0)
-        
-        if index + 1 >= len(tree_bytes):
+        # Últimos 2 bytes são zeros
+        if len(raw_huff) - 2 < 2:
             return None
         
-        h_byte = tree_bytes[index + 1]
-        l_byte = tree_bytes[index]
-        
-        # Se é um nó interno (0x80XX)
-        if (h_byte & 0xF0) == 0x80:
-            node = (h_byte << 8) + l_byte - 0x8000
-            # Cria novo nó com filhos
-            temp = [None, None]
-            temp[0] = HuffmanDecoder.parse_tree(0, offset, node, tree_bytes)
-            temp[1] = HuffmanDecoder.parse_tree(1, offset, node, tree_bytes)
-            return temp
-        
-        # Códigos de controle
-        elif h_byte == 0x7F or h_byte == 0x7E:
-            return "{%02x%02x}" % (h_byte, l_byte)
-        
-        # Fim de texto
-        elif h_byte == 0 and l_byte == 0:
-            return "{0000}"
-        
-        # Caractere Shift-JIS
-        else:
-            h_byte += 0x80
-            enc_letter = (h_byte << 8) + l_byte
-            return HuffmanDecoder.decode_shift_jis(enc_letter)
-    
-    @staticmethod
-    def make_huff_tree(raw_huff: bytes) -> list:
-        """Constrói árvore Huffman a partir dos bytes"""
-        root = [None, None]
-        
-        # Remove últimos 2 bytes (zeros)
-        raw_huff = list(raw_huff)[:-2]
-        raw_length = len(raw_huff)
-        
-        if raw_length < 2:
-            return root
-        
-        half = int(raw_length / 2)
-        
-        # Calcula nó raiz
-        l_byte = raw_huff[raw_length - 2] + (raw_huff[raw_length - 1] << 8)
-        root_node = 1 + l_byte - 0x8000
-        
-        root[0] = HuffmanDecoder.parse_tree(0, half, root_node, raw_huff)
-        root[1] = HuffmanDecoder.parse_tree(1, half, root_node, raw_huff)
-        
-        return root
+        return treePool.get(raw_huff, strict=False)
     
     @staticmethod
-    def decode_huffman(offset: int, code: bytes, huff_tree: list) -> list:
+    def decode_huffman(offset: int, code: bytes, huff_tree: HuffTree) -> list:
         """
         Decodifica dados comprimidos usando árvore Huffman.
+
+        Usa a tabela de consulta multi-bit de libs.huffman (um símbolo por
+        consulta) em vez de percorrer a árvore bit a bit.
         
         Returns:
             Lista de dicionários com 'text' e 'offset'
         """
-        d_text = ""
-        dialog = []
-        temp_tree = huff_tree
-        byte_idx = 0
-        start = offset
-        start_bit = 0
-        
-        for byte in code:
-            # Processa cada bit do byte
-            for i in range(8):
-                # Verifica se bit é 1 ou 0
-                bit_code = 1 if (byte & (1 << i) > 0) else 0
-                
-                # Se é lista, continua navegando
-                if isinstance(temp_tree[bit_code], list):
-                    temp_tree = temp_tree[bit_code]
-                else:
-                    # Encontrou folha
-                    d_text = ''.join([d_text, temp_tree[bit_code]])
-                    
-                    # Se encontrou fim de texto
-                    if temp_tree[bit_code] == '{0000}':
-                        bit_offset = start * 8 + start_bit
-                        dialog.append({
-                            'text': d_text,
-                            'offset': '0x%04X' % bit_offset
-                        })
-                        d_text = ""
-                        start = byte_idx + offset
-                        start_bit = i + 1
-                    
-                    temp_tree = huff_tree
-            
-            byte_idx += 1
-        
-        return dialog
+        return huff_tree.decodeTable().decode(offset, code)
+
+    @staticmethod
+    def iter_decode_huffman(offset: int, code: bytes, huff_tree: HuffTree):
+        """
+        Versão em streaming de decode_huffman.
+
+        Gera (offset_em_bits, texto) assim que cada {0000} é encontrado, sem
+        montar a lista inteira do bloco.
+        """
+        return huff_tree.decodeTable().iterDecode(offset, code)
+
+    @staticmethod
+    def decode_at(offset: int, code: bytes, huff_tree: HuffTree, bit_offset: int) -> Optional[str]:
+        """
+        Decodifica um único diálogo a partir do offset em bits (o mesmo de 'offset').
+
+        Para no primeiro {0000} e reutiliza a tabela de decodificação da árvore.
+        Retorna None se o código acabar antes do terminador.
+        """
+        return huff_tree.decodeTable().decodeAt(code, bit_offset, offset)
 
 class DQ4ExtractorWithMapping:
     """Extrator com mapeamento completo de endereços"""
@@ -176,13 +128,25 @@ class DQ4ExtractorWithMapping:
         '{7f42}': '<TOWN>'
     }
     
-    def __init__(self, q41_path: str):
+    def __init__(self, q41_path: str, cache_dir: Optional[str] = None, index_path: Optional[str] = None,
+                 workers: int = 1, manifest_path: Optional[str] = None):
         self.q41_path = q41_path
+        self.index_path = index_path
+        self.workers = workers
+        # Com manifesto, só os text blocks alterados desde a última execução são decodificados
+        self.manifest_path = manifest_path
+        self.manifest_entries = []
+        self.next_dialog_id = 1
+        self.pool_stats = None
+        # Cache em disco das árvores já parseadas (execuções seguintes não parseiam de novo)
+        if cache_dir:
+            treePool.cache = TreeCache(cache_dir)
         self.dialogs = OrderedDict()
         self.text_blocks_processed = 0
         self.valid_dialogs = 0
         self.decoder = HuffmanDecoder()
         self.address_map = []  # Lista para rastrear endereços
+        self.dialog_index = DialogIndex()  # ID / uuid / offset -> bloco, sub-bloco, bit
     
     def human_readable_text(self, text: str) -> str:
         """Converte códigos de controle para texto legível"""
@@ -252,19 +216,12 @@ class DQ4ExtractorWithMapping:
             # Constrói árvore Huffman
             huff_tree = self.decoder.make_huff_tree(enc_huff_tree)
             
-            if not huff_tree or (not huff_tree[0] and not huff_tree[1]):
+            if not huff_tree or huff_tree.isEmpty():
                 return None
             
-            # Decodifica textos
-            dec_text = self.decoder.decode_huffman(huff_c, enc_data, huff_tree)
-            
-            if not dec_text:
-                return None
-            
-            # Extrai textos válidos com endereços
+            # Decodifica textos (streaming, um diálogo por vez)
             texts = []
-            for line in dec_text:
-                text = line['text']
+            for relative_offset, text in self.decoder.iter_decode_huffman(huff_c, enc_data, huff_tree):
 
                 # Ignora diálogos dummy ou vazios
                 if "ダミー{7f0b}{0000}" in text or text == "{0000}":
@@ -275,12 +232,11 @@ class DQ4ExtractorWithMapping:
 
                 if len(readable_text) > 0:
                     # Calcula endereço absoluto no arquivo
-                    relative_offset = int(line.get('offset', '0x0000'), 16)
                     absolute_offset = block_offset + relative_offset
                     
                     texts.append({
                         'text': readable_text,
-                        'raw_offset': line.get('offset'),
+                        'raw_offset': '0x%04X' % relative_offset,
                         'relative_offset': relative_offset,
                         'absolute_offset': absolute_offset,
                     })
@@ -305,6 +261,115 @@ class DQ4ExtractorWithMapping:
         except Exception as e:
             return None
     
+    def parse_subblocks(self, mm, subblocks):
+        """Gera (sub-bloco do índice, resultado de parse_text_block) em ordem"""
+        for sb in subblocks:
+            if not 0 < sb.compLength < 10 * 1024 * 1024:
+                yield sb, None
+                continue
+            raw_data = mm[sb.bodyOffset:sb.bodyOffset + sb.compLength]
+            yield sb, self.parse_text_block(raw_data, sb.bodyOffset, sb.idx)
+
+    def add_parsed(self, index, sb, parsed, ids=()):
+        """
+        Numera os diálogos de um sub-bloco e registra no mapa de endereços.
+        `ids` são os IDs que o sub-bloco tinha na execução anterior (modo
+        incremental); são reaproveitados em ordem e os que faltarem são novos.
+        """
+        assigned = []
+        if not parsed:
+            return assigned
+        block_start_offset = index.blocks[sb.block].offset
+        subblock_body_offset = sb.bodyOffset
+        subblock_header_offset = subblock_body_offset - 16
+        uuid = parsed.get('uuid')
+        for n, entry in enumerate(parsed.get('texts', [])):
+            if n < len(ids):
+                dialog_id = ids[n]
+            else:
+                dialog_id = self.next_dialog_id
+                self.next_dialog_id += 1
+            
+            # Armazena metadados completos para reinserção
+            self.record_dialog(dialog_id, {
+                'text': entry.get('text'),
+                'uuid': uuid,
+                'block_start_offset': block_start_offset,
+                'subblock_body_offset': subblock_body_offset,
+                'subblock_header_offset': subblock_header_offset,
+                'block_type': sb.type,
+                'absolute_offset': entry.get('absolute_offset'),
+                'relative_offset': entry.get('relative_offset'),
+                'raw_offset': entry.get('raw_offset'),
+                'huff_tree_start': parsed.get('huff_tree_start'),
+                'huff_tree_end': parsed.get('huff_tree_end'),
+                'huff_c': parsed.get('huff_c'),
+                'huff_e': parsed.get('huff_e'),
+                'subblock_idx': sb.idx
+            })
+            assigned.append(dialog_id)
+        return assigned
+
+    def record_dialog(self, dialog_id, info):
+        """Registra um diálogo em self.dialogs, no mapa de endereços e no índice"""
+        dialog_id_hex = f"{dialog_id:04X}"
+        self.dialogs[dialog_id_hex] = info
+        
+        # Adiciona ao mapa de enderecos
+        self.address_map.append({
+            'dialog_id': dialog_id,
+            'dialog_id_hex': f'0x{dialog_id_hex}',
+            'block_start': hex(info['block_start_offset']),
+            'subblock_header': hex(info['subblock_header_offset']),
+            'subblock_body': hex(info['subblock_body_offset']),
+            'absolute_text_offset': hex(info['absolute_offset']),
+            'uuid': info['uuid'],
+            'text_preview': info['text'][:100]
+        })
+        self.dialog_index.add(dialog_id, info['uuid'], info['block_start_offset'],
+                              info['subblock_header_offset'], info['subblock_body_offset'],
+                              info['subblock_idx'], info['relative_offset'], info['absolute_offset'])
+
+    def parse_parallel(self, subblocks):
+        """
+        Decodifica os text blocks em self.workers processos.
+
+        Os sub-blocos são divididos em fatias contíguas que nunca cortam um
+        bloco; cada processo lê sua fatia do Q41 por mmap e devolve os
+        resultados de parse_text_block. As fatias voltam na ordem original,
+        então os IDs dos diálogos são os mesmos da execução serial.
+
+        Retorna a lista de (sub-bloco, resultado) já completa: o pool é
+        fechado aqui mesmo, e nenhum processo sobrevive à extração se ela
+        for interrompida no meio.
+        """
+        shards = make_shards(subblocks, self.workers * 4)
+        print(f"[*] {len(shards)} fatias em {self.workers} processos")
+        cache_dir = treePool.cache.root if treePool.cache is not None else None
+
+        total = self.pool_stats = {'lookups': 0, 'hits': 0, 'diskHits': 0, 'written': 0}
+        parsed = []
+        with ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker,
+                                 initargs=(self.q41_path, cache_dir)) as executor:
+            for shard, (results, stats) in zip(shards, executor.map(_extract_shard, shards)):
+                for key in total:
+                    total[key] += stats[key]
+                parsed.extend(zip(shard, results))
+        return parsed
+
+    def load_manifest(self):
+        """Manifesto da execução anterior (modo incremental), ou None"""
+        if not self.manifest_path or not os.path.exists(self.manifest_path):
+            return None
+        try:
+            with open(self.manifest_path, 'r', encoding='utf-8') as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if manifest.get('version') != MANIFEST_VERSION:
+            return None
+        return manifest
+
     def extract_all_texts(self):
         """Extrai todos os textos do arquivo com mapeamento de endereços"""
         print(f"\n[FASE 1] Parseando arquivo HBD1PS1D...")
@@ -316,112 +381,100 @@ class DQ4ExtractorWithMapping:
         
         file_size = os.path.getsize(self.q41_path)
         print(f"[*] Tamanho: {file_size:,} bytes")
+        if file_size == 0:
+            print(f"[!] Arquivo vazio!")
+            return False
         
         print(f"\n[FASE 2] Extraindo textos com decodificação Huffman completa...")
         
-        with open(self.q41_path, 'rb') as f:
-            blocks_found = 0
-            text_blocks_found = 0
-            dialog_id = 0
-            
-            offset = 0
-            while offset < file_size:
-                f.seek(offset)
-                magic = f.read(8)
-                
-                if magic == MAGIC_HEADER:
-                    block_start_offset = offset
-                    # Lê header do bloco
-                    header = f.read(16)
-                    if len(header) < 16:
-                        break
-                    
-                    num_sub, num_sect, total_len, zero = struct.unpack('<IIII', header)
-                    
-                    # Valida
-                    if 1 <= num_sub <= 20 and 1 <= num_sect <= 200 and total_len > 0:
-                        blocks_found += 1
-                        
-                        # Lê headers dos sub-blocos
-                        subblock_headers = []
-                        for i in range(num_sub):
-                            sb_header = f.read(16)
-                            if len(sb_header) < 16:
-                                break
-                            
-                            data_len, uncomp_len, unk, comp_flag, block_type = struct.unpack('<IIIHH', sb_header)
-                            subblock_headers.append((data_len, uncomp_len, unk, comp_flag, block_type))
-                        
-                        # Lê dados dos sub-blocos
-                        subblock_idx = 0
-                        for data_len, uncomp_len, unk, comp_flag, block_type in subblock_headers:
-                            if data_len > 0 and data_len < 10 * 1024 * 1024:
-                                # guarda offsets antes de ler os dados
-                                subblock_body_offset = f.tell()
-                                subblock_header_offset = subblock_body_offset - 16
-                                raw_data = f.read(data_len)
-
-                                # Processa sub-blocos de texto (tipo 40 ou 42)
-                                if block_type == 40 or block_type == 42:
-                                    text_blocks_found += 1
-
-                                    parsed = self.parse_text_block(raw_data, subblock_body_offset, subblock_idx)
-
-                                    if parsed:
-                                        uuid = parsed.get('uuid')
-                                        for entry in parsed.get('texts', []):
-                                            dialog_id += 1
-                                            dialog_id_hex = f"{dialog_id:04X}"
-                                            
-                                            # Armazena metadados completos para reinserção
-                                            self.dialogs[dialog_id_hex] = {
-                                                'text': entry.get('text'),
-                                                'uuid': uuid,
-                                                'block_start_offset': block_start_offset,
-                                                'subblock_body_offset': subblock_body_offset,
-                                                'subblock_header_offset': subblock_header_offset,
-                                                'block_type': block_type,
-                                                'absolute_offset': entry.get('absolute_offset'),
-                                                'relative_offset': entry.get('relative_offset'),
-                                                'raw_offset': entry.get('raw_offset'),
-                                                'huff_tree_start': parsed.get('huff_tree_start'),
-                                                'huff_tree_end': parsed.get('huff_tree_end'),
-                                                'huff_c': parsed.get('huff_c'),
-                                                'huff_e': parsed.get('huff_e'),
-                                                'subblock_idx': subblock_idx
-                                            }
-                                            
-                                            # Adiciona ao mapa de enderecos
-                                            self.address_map.append({
-                                                'dialog_id': dialog_id,
-                                                'dialog_id_hex': f'0x{dialog_id_hex}',
-                                                'block_start': hex(block_start_offset),
-                                                'subblock_header': hex(subblock_header_offset),
-                                                'subblock_body': hex(subblock_body_offset),
-                                                'absolute_text_offset': hex(entry.get('absolute_offset')),
-                                                'uuid': uuid,
-                                                'text_preview': entry.get('text')[:100]
-                                            })
-                            
-                            subblock_idx += 1
-                        
-                        # Progress
-                        if blocks_found % 500 == 0:
-                            progress = (offset / file_size) * 100
-                            print(f"  [{blocks_found:4d} blocos] {progress:.1f}% - {len(self.dialogs)} diálogos extraídos")
-                        
-                        # Pula para próximo bloco
-                        offset += num_sect * 2048
-                    else:
-                        offset += 2048
+        # Índice de blocos/sub-blocos (gerado uma vez e salvo ao lado do Q41)
+        index = HBD1Index.open(self.q41_path, self.index_path)
+        blocks_found = len(index.blocks)
+        text_subblocks = index.textBlocks()
+        text_blocks_found = len(text_subblocks)
+        print(f"[*] Índice: {blocks_found:,} blocos, {len(index.subBlocks):,} sub-blocos")
+        self.dialog_index = DialogIndex(index.hash)
+
+        with open(self.q41_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            # Modo incremental: CRC32 de cada text block, comparado com o manifesto.
+            # O n-ésimo text block herda os IDs do n-ésimo da execução anterior;
+            # só é decodificado de novo se o conteúdo ou a posição mudaram.
+            previous = self.load_manifest()
+            old_entries = previous['subblocks'] if previous else []
+            old_dialogs = previous['dialogs'] if previous else {}
+            self.next_dialog_id = previous['next_id'] if previous else 1
+            entries = []
+            reuse = set()
+            if self.manifest_path:
+                for n, sb in enumerate(text_subblocks):
+                    crc = zlib.crc32(mm[sb.bodyOffset:sb.bodyOffset + sb.compLength])
+                    entries.append({'body': sb.bodyOffset, 'length': sb.compLength, 'crc': crc, 'ids': []})
+                    if n < len(old_entries) and all(old_entries[n][k] == entries[n][k]
+                                                    for k in ('body', 'length', 'crc')):
+                        reuse.add(n)
+                if previous:
+                    print(f"[*] Incremental: {text_blocks_found - len(reuse):,} text blocks alterados")
+            todo = [sb for n, sb in enumerate(text_subblocks) if n not in reuse]
+
+            self.pool_stats = None
+            if self.workers > 1 and todo:
+                results = iter(self.parse_parallel(todo))
+            else:
+                results = self.parse_subblocks(mm, todo)
+
+            done = 0
+            for n, sb in enumerate(text_subblocks):
+                old_ids = old_entries[n]['ids'] if n < len(old_entries) else []
+                if n in reuse:
+                    for dialog_id in old_ids:
+                        self.record_dialog(dialog_id, old_dialogs[f"{dialog_id:04X}"])
+                    ids = old_ids
                 else:
-                    offset += 2048
+                    _, parsed = next(results)
+                    ids = self.add_parsed(index, sb, parsed, old_ids)
+                if entries:
+                    entries[n]['ids'] = ids
+
+                # Progress
+                done += 1
+                if done % 500 == 0:
+                    progress = (done / text_blocks_found) * 100
+                    print(f"  [{done:4d} text blocks] {progress:.1f}% - {len(self.dialogs)} diálogos extraídos")
+            self.manifest_entries = entries
         
         print(f"[✓] {blocks_found:,} blocos processados")
         print(f"[✓] {text_blocks_found:,} text blocks encontrados")
         print(f"[✓] {len(self.dialogs):,} diálogos únicos extraídos!")
+
+        pool = self.pool_stats
+        if pool is None:
+            pool = treePool.stats()
+            print(f"[✓] {pool['distinct']:,} árvores Huffman distintas de {pool['lookups']:,} lidas "
+                  f"({pool['savedMemory'] / 1024:.1f} KB e {pool['savedTime']:.2f}s de parse economizados)")
+            if treePool.cache is not None:
+                pool['written'] = treePool.flush()
+        else:
+            print(f"[✓] {pool['lookups']:,} árvores Huffman lidas em {self.workers} processos, "
+                  f"{pool['hits']:,} reaproveitadas")
+        if treePool.cache is not None:
+            print(f"[✓] Cache de árvores: {pool['diskHits']:,} carregadas do disco, {pool['written']:,} gravadas")
         
         return True
+
+    def export_manifest(self):
+        """Salva o manifesto usado pelo modo incremental"""
+        os.makedirs(os.path.dirname(self.manifest_path) or '.', exist_ok=True)
+        manifest = {
+            'version': MANIFEST_VERSION,
+            'source_file': os.path.basename(self.q41_path),
+            'next_id': self.next_dialog_id,
+            'subblocks': self.manifest_entries,
+            'dialogs': self.dialogs
+        }
+        with open(self.manifest_path, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, ensure_ascii=False)
+        print(f"[✓] Manifesto incremental: {self.manifest_path}")
+        return self.manifest_path
     
     def export_address_mapping(self, output_dir='tools_output'):
         """Exporta CSV com mapeamento completo de endereços"""
@@ -457,6 +510,14 @@ class DQ4ExtractorWithMapping:
         print(f"[✓] Address Mapping CSV: {map_file}")
         return map_file
     
+    def export_dialog_index(self, output_dir='tools_output'):
+        """Salva o índice binário de diálogos (libs.dialogindex)"""
+        os.makedirs(output_dir, exist_ok=True)
+        index_file = os.path.join(output_dir, 'dq4_dialog_index.bin')
+        self.dialog_index.save(index_file)
+        print(f"[✓] Índice de diálogos: {index_file}")
+        return index_file
+    
     def export_json(self, output_dir='tools_output'):
         """Exporta em JSON com endereços"""
         os.makedirs(output_dir, exist_ok=True)
@@ -552,6 +613,9 @@ class DQ4ExtractorWithMapping:
         json_file = self.export_json()
         txt_file = self.export_txt()
         map_file = self.export_address_mapping()
+        index_file = self.export_dialog_index()
+        if self.manifest_path:
+            self.export_manifest()
         
         # Resumo
         print(f"\n[RESUMO FINAL]")
@@ -573,16 +637,57 @@ class DQ4ExtractorWithMapping:
         print(f"  - {json_file}")
         print(f"  - {txt_file}")
         print(f"  - {map_file}")
+        print(f"  - {index_file}")
         
         return True
 
+def make_shards(subblocks, count):
+    """Divide a lista em até `count` fatias contíguas sem separar sub-blocos do mesmo bloco"""
+    if not subblocks:
+        return []
+    target = max(1, -(-len(subblocks) // count))
+    shards = [[]]
+    for sb in subblocks:
+        current = shards[-1]
+        if len(current) >= target and current[-1].block != sb.block:
+            shards.append([])
+        shards[-1].append(sb)
+    return shards
+
+# Estado de cada processo do modo paralelo
+_worker = None
+_worker_mm = None
+
+def _init_worker(q41_path, cache_dir):
+    global _worker, _worker_mm
+    _worker = DQ4ExtractorWithMapping(q41_path, cache_dir=cache_dir)
+    f = open(q41_path, 'rb')
+    _worker_mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    f.close()
+
+def _extract_shard(shard):
+    before = treePool.stats()
+    results = [parsed for sb, parsed in _worker.parse_subblocks(_worker_mm, shard)]
+    after = treePool.stats()
+    stats = {key: after[key] - before[key] for key in ('lookups', 'hits', 'diskHits')}
+    stats['written'] = treePool.flush()
+    return results, stats
+
 def main():
     """Função principal"""
     # Prefer input/HBD1PS1D.Q41 in the workspace
     base_dir = os.path.dirname(__file__)
     project_root = os.path.dirname(base_dir)
     default_q41 = os.path.join(project_root, 'input', 'HBD1PS1D.Q41')
-    q41_path = default_q41
+    parser = argparse.ArgumentParser(description='Extrator de textos do DQ4 com mapeamento de endereços')
+    parser.add_argument('--q41', default=default_q41, help='Arquivo HBD1PS1D.Q41')
+    parser.add_argument('-j', '--workers', type=int, default=1,
+                        help='Processos para decodificar os text blocks (0 = todos os núcleos)')
+    parser.add_argument('--incremental', action='store_true',
+                        help=f'Decodifica só os text blocks alterados desde a última execução ({MANIFEST_JSON})')
+    args = parser.parse_args()
+    q41_path = args.q41
+    workers = args.workers or os.cpu_count() or 1
 
     if not os.path.exists(q41_path):
         print(f"[!] Arquivo Q41 não encontrado em '{q41_path}'")
@@ -591,7 +696,9 @@ def main():
     print(f"[✓] Q41: {os.path.getsize(q41_path):,} bytes")
     print()
 
-    extractor = DQ4ExtractorWithMapping(q41_path)
+    extractor = DQ4ExtractorWithMapping(q41_path, cache_dir=os.path.join(project_root, 'cache', 'huffman'),
+                                        workers=workers,
+                                        manifest_path=MANIFEST_JSON if args.incremental else None)
     
     # Executa extração completa
     success = extractor.run()
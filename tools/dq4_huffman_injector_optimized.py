@@ -27,9 +27,11 @@ if sys.stdout.encoding != 'utf-8':
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
 
 from libs.huffman import (
-    makeHuffTree, decodeHuffman, encodeHuffman,
-    encodeWithTree, _build_code_map_from_tree
+    parseHuffTree, decodeHuffman, encodeHuffman,
+    encodeWithTree, encodedSize, _build_code_map_from_tree
 )
+from libs.hbd1index import HBD1Index
+from libs.dialogindex import DialogIndex
 
 # ============================================================================
 # CONFIGURAÇÕES
@@ -37,6 +39,7 @@ from libs.huffman import (
 
 INPUT_ROM = 'input/HBD1PS1D.Q41'
 ADDRESS_MAP_CSV = 'tools_output/dq4_address_mapping.csv'
+DIALOG_INDEX = 'tools_output/dq4_dialog_index.bin'
 TRANSLATION_CSV = 'translation_files/dq4_translation_para_injetar.csv'
 OUTPUT_ROM = 'tools_output/HBD1PS1D_TRADUZIDO.Q41'
 REPORT_CSV = 'tools_output/dq4_injection_report.csv'
@@ -126,6 +129,27 @@ def load_address_map(csv_path):
     
     return addr_map
 
+def load_dialog_index(index_path, rom_path, csv_path):
+    """
+    Mapa por ID a partir do índice binário do extrator (mesmos campos de
+    load_address_map). Usa o CSV se o índice não existir ou for de outra ROM.
+    """
+    index = None
+    if os.path.exists(index_path) and os.path.exists(rom_path):
+        index = DialogIndex.load(index_path, HBD1Index.open(rom_path).hash)
+    if index is None:
+        return load_address_map(csv_path)
+
+    addr_map = {}
+    for rec in index.records:
+        addr_map['0x%04X' % rec.dialogId] = {
+            'BLOCK_START_OFFSET': rec.blockOffset,
+            'SUBBLOCK_HEADER_OFFSET': rec.subBlockHeader,
+            'SUBBLOCK_BODY_OFFSET': rec.subBlockBody,
+            'ABSOLUTE_TEXT_OFFSET': rec.absoluteOffset
+        }
+    return addr_map
+
 def load_rom(rom_path):
     """Carrega ROM em memória (como bytearray)."""
     try:
@@ -169,7 +193,7 @@ def extract_huffman_tree(rom_bytes, offset, window_size=512):
                 # candidate tree bytes start at i
                 tree_bytes = rom_bytes[i:i+200]
                 try:
-                    tree = makeHuffTree(tree_bytes)
+                    tree = parseHuffTree(tree_bytes)
                     return (tree, i)
                 except Exception:
                     continue
@@ -236,9 +260,19 @@ def strategy_tree_reuse(rom_bytes, offset, new_text, max_size, cached_tree=None)
     """Desabilitada - muito lenta."""
     return (None, None, False, 'Tree-reuse desabilitada')
 
-def strategy_new_tree(rom_bytes, offset, new_text, max_size, header_offset=None):
-    """Estratégia: Reconstruir árvore nova (rápido)."""
+def strategy_new_tree(rom_bytes, offset, new_text, max_size, header_offset=None, dry_run=False):
+    """Estratégia: Reconstruir árvore nova (rápido).
+
+    O tamanho é calculado antes com encodedSize; textos que não cabem (e todos
+    no dry-run) não chegam a gerar o bitstream.
+    """
     try:
+        code_len, tree_len = encodedSize(new_text)
+        if code_len > max_size:
+            return (None, None, False, f'Tamanho insuficiente: {code_len} > {max_size}')
+        if dry_run:
+            return (None, None, True, f'new-tree OK ({code_len} bytes)')
+
         encoded_res = encodeHuffman(new_text)
         if isinstance(encoded_res, (list, tuple)) and len(encoded_res) >= 1:
             encoded_bytes = encoded_res[0]
@@ -261,14 +295,14 @@ def strategy_abbreviate(rom_bytes, offset, new_text, max_size):
     """Desabilitada - fallback muito fraco."""
     return (None, None, False, 'Abbreviate desabilitada')
 
-def inject_text(rom_bytes, offset, new_text, max_size, mode='new-tree', cached_tree=None, header_offset=None):
+def inject_text(rom_bytes, offset, new_text, max_size, mode='new-tree', cached_tree=None, header_offset=None, dry_run=False):
     """Executa injeção apenas com new-tree (rápido)."""
     
     if mode in ['tree-reuse', 'safe', 'aggressive']:
         mode = 'new-tree'  # Força new-tree
     
     # Apenas new-tree
-    encoded, tree_patch, success, msg = strategy_new_tree(rom_bytes, offset, new_text, max_size, header_offset=header_offset)
+    encoded, tree_patch, success, msg = strategy_new_tree(rom_bytes, offset, new_text, max_size, header_offset=header_offset, dry_run=dry_run)
     return (success, encoded, msg, tree_patch)
 
 # ============================================================================
@@ -328,7 +362,7 @@ def run_injection(mode='safe', dry_run=False, verbose=False, log_per_block=False
     
     # Carregar dados
     translations = load_translations(TRANSLATION_CSV)
-    address_map = load_address_map(ADDRESS_MAP_CSV)
+    address_map = load_dialog_index(DIALOG_INDEX, INPUT_ROM, ADDRESS_MAP_CSV)
     rom_bytes = load_rom(INPUT_ROM)
     
     if not rom_bytes:
@@ -368,7 +402,7 @@ def run_injection(mode='safe', dry_run=False, verbose=False, log_per_block=False
         # Injetar usando estratégia (apenas new-tree)
         success, encoded, msg, tree_patch = inject_text(
             rom_bytes, offset, new_text, max_size, 
-            mode='new-tree', cached_tree=None, header_offset=header_offset
+            mode='new-tree', cached_tree=None, header_offset=header_offset, dry_run=dry_run
         )
         
         if success:
@@ -409,7 +443,9 @@ def run_injection(mode='safe', dry_run=False, verbose=False, log_per_block=False
             if verbose:
                 log(f'[OK] {id_hex}: {msg}')
 
-            injection_log.append([id_hex, 'OK', len(encoded) if encoded else 0, msg])
+            # No dry-run não há bytes, só o tamanho calculado
+            encoded_size = len(encoded) if encoded else encodedSize(new_text)[0]
+            injection_log.append([id_hex, 'OK', encoded_size, msg])
         else:
             fail_count += 1
             if verbose:
@@ -465,7 +501,7 @@ if __name__ == '__main__':
     if args.analyze:
         rom_bytes = load_rom(INPUT_ROM)
         if rom_bytes:
-            address_map = load_address_map(ADDRESS_MAP_CSV)
+            address_map = load_dialog_index(DIALOG_INDEX, INPUT_ROM, ADDRESS_MAP_CSV)
             analyze_blocks(rom_bytes, address_map, ANALYSIS_CSV)
     else:
         # Aplicar limite se especificado
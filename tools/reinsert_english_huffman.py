@@ -6,11 +6,13 @@ import sys
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
 
 from libs import huffman
+from libs.treecache import TreeCache
 
 Q41_PATH = os.path.join('input', 'HBD1PS1D.Q41')
 ADDRESS_MAP_PATH = os.path.join('tools_output', 'dq4_address_mapping.csv')
 TRANSLATION_CSV_PATH = os.path.join('translation_files', 'dq4_translation_para_injetar.csv')
 REPORT_PATH = os.path.join('tools_output', 'reinsert_english_report.csv')
+CACHE_DIR = os.path.join('cache', 'huffman')
 
 # Helper to read translation CSV (ID_HEX -> ENGLISH)
 def load_translations(csv_path):
@@ -54,7 +56,7 @@ def extract_huffman_tree(q41_bytes, offset):
     for i in range(len(window)):
         if window[i:i+2] == b'\x00\x00':
             try:
-                tree = huffman.makeHuffTree(window[i:])
+                tree = huffman.treePool.get(window[i:])
                 return tree
             except Exception:
                 continue
@@ -62,6 +64,7 @@ def extract_huffman_tree(q41_bytes, offset):
 
 # Main reinsertion routine
 def reinsert_english():
+    huffman.treePool.cache = TreeCache(CACHE_DIR)
     translations = load_translations(TRANSLATION_CSV_PATH)
     address_map = load_address_map(ADDRESS_MAP_PATH)
     with open(Q41_PATH, 'rb') as f:
@@ -107,6 +110,9 @@ def reinsert_english():
         writer = csv.writer(f)
         writer.writerow(['ID_HEX', 'STATUS', 'ENCODED_LEN', 'METHOD'])
         writer.writerows(report)
+    huffman.treePool.flush()
+    stats = huffman.codeMapCache.stats()
+    print(f'Code map cache: {stats["hits"]} hits, {stats["misses"]} misses')
     print(f'Reinsertion complete. Output: {Q41_PATH.replace(".Q41", "_ENGLISH.Q41")}, Report: {REPORT_PATH}')
 
 if __name__ == '__main__':
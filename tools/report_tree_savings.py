@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Relatório: bytes economizados por encodeHuffmanOptimal em relação a encodeHuffman
+
+Para cada bloco (agrupado como em benchmark_huffman_tree.py) calcula o tamanho
+código + árvore dos dois construtores com encodedSize, sem gerar bitstreams,
+e grava um CSV por bloco com o total no final.
+"""
+
+import os
+import sys
+import csv
+import argparse
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(__file__))
+
+from libs.huffman import encodedSize, genFreqTable
+from benchmark_huffman_tree import load_texts, block_alphabets
+
+TRANSLATION_CSV = os.path.join('translation_files', 'dq4_translation_para_injetar.csv')
+REPORT_CSV = os.path.join('tools_output', 'dq4_tree_savings.csv')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Economia do construtor de árvore ótimo por bloco')
+    parser.add_argument('--csv', default=TRANSLATION_CSV, help='CSV de tradução (pipe)')
+    parser.add_argument('--column', type=int, default=1, help='Coluna do texto')
+    parser.add_argument('--group', type=int, default=64, help='Diálogos por bloco sem mapeamento')
+    parser.add_argument('--out', default=REPORT_CSV, help='CSV de saída')
+    args = parser.parse_args()
+
+    texts = load_texts(args.csv, args.column)
+    blocks = [b for b in block_alphabets(texts, args.group) if len(genFreqTable(b)) > 1]
+
+    rows = []
+    total_plain = 0
+    total_optimal = 0
+    for idx, block in enumerate(blocks):
+        try:
+            plain = sum(encodedSize(block))
+            optimal = sum(encodedSize(block, optimal=True))
+        except Exception as e:
+            print(f'[!] Bloco {idx}: {e}')
+            continue
+        rows.append([idx, plain, optimal, plain - optimal])
+        total_plain += plain
+        total_optimal += optimal
+
+    os.makedirs(os.path.dirname(args.out) or '.', exist_ok=True)
+    with open(args.out, 'w', encoding='utf-8', newline='') as f:
+        writer = csv.writer(f, delimiter='|')
+        writer.writerow(['BLOCK', 'ENCODE_HUFFMAN', 'OPTIMAL', 'SAVED'])
+        writer.writerows(rows)
+        writer.writerow(['TOTAL', total_plain, total_optimal, total_plain - total_optimal])
+
+    print(f'[*] {len(rows):,} blocos')
+    print(f'[*] encodeHuffman: {total_plain:,} bytes')
+    print(f'[*] Ótimo:         {total_optimal:,} bytes')
+    if total_plain:
+        saved = total_plain - total_optimal
+        print(f'[✓] Economia: {saved:,} bytes ({saved * 100 / total_plain:.2f}%)')
+    print(f'[✓] Relatório: {args.out}')
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
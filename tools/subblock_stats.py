@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Estatísticas de todos os sub-blocos do HBD1PS1D.Q41
+
+Monta a tabela NumPy de cabeçalhos (libs.hbd1index.subBlockTable) a partir do
+índice do Q41 e mostra, por tipo, a quantidade de sub-blocos, bytes
+comprimidos / descomprimidos e os flags encontrados.
+"""
+
+import os
+import sys
+import argparse
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, ROOT)
+
+from libs.hbd1index import HBD1Index, subBlockTable
+
+Q41_PATH = os.path.join('input', 'HBD1PS1D.Q41')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Estatísticas dos sub-blocos do Q41')
+    parser.add_argument('--q41', default=Q41_PATH, help='Arquivo HBD1PS1D.Q41')
+    args = parser.parse_args()
+
+    if not os.path.exists(args.q41):
+        print(f"[!] Arquivo Q41 '{args.q41}' não encontrado.")
+        return 1
+
+    try:
+        import numpy as np
+    except ImportError:
+        print('[!] Este relatório precisa do numpy (pip install numpy)')
+        return 1
+
+    table = subBlockTable(HBD1Index.open(args.q41))
+    print(f'[*] {len(table):,} sub-blocos')
+    print(f"{'TIPO':>6} {'QTD':>8} {'COMPRIMIDO':>14} {'DESCOMPRIMIDO':>14}  FLAGS")
+    for t in np.unique(table['type']):
+        rows = table[table['type'] == t]
+        flags = ', '.join(f'{f}({n})' for f, n in zip(*np.unique(rows['flags'], return_counts=True)))
+        print(f"{t:6d} {len(rows):8,d} {int(rows['compLength'].sum()):14,d} "
+              f"{int(rows['length'].sum()):14,d}  {flags}")
+    print(f"[✓] Total: {int(table['compLength'].sum()):,} bytes comprimidos, "
+          f"{int(table['length'].sum()):,} descomprimidos")
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())